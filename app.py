@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import stat
 import sys
 import time
 import logging
@@ -16,6 +17,24 @@ import humanize
 import locale
 import time
 import re
+import sqlite3
+import threading
+import codecs
+import unicodedata
+import ctypes
+import errno
+import select
+import signal
+import struct
+import functools
+import gzip
+import csv
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
 
 # 设置时区和语言环境
 try:
@@ -175,70 +194,281 @@ def load_config(config_file='config.ini'):
     
     return config
 
-# 应用路径映射，将下载器路径转换为NAS路径
-def apply_path_mapping(file_path, path_mappings_str):
-    if not path_mappings_str:
-        return file_path
-    
-    # 规范化原始路径
-    norm_path = os.path.normpath(file_path)
-    original_norm_path = norm_path  # 保存原始规范化路径，用于调试
-    
-    # 解析映射配置
-    path_mappings = {}
-    try:
-        # 处理多个路径映射配置
-        for mapping in path_mappings_str.split(','):
+# 获取状态文件保存目录（与输出文件同目录），用于保存跨运行的同步状态和缓存
+def get_state_directory(config):
+    output_file_prefix = config['general'].get('output_file', '') if 'general' in config else ''
+    state_dir = os.path.dirname(output_file_prefix) if output_file_prefix else ''
+    if not state_dir:
+        state_dir = '/app/output'
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+# 路径映射器：将 path_mappings 配置预先编译为按路径组件匹配的前缀树，总是使用最长(最具体)的匹配规则
+# 例如 /data 不会匹配 /data2/...，同时配置 /data 和 /data/movies 时 /data/movies/... 使用后者
+class PathMapper:
+    # 前缀树节点中保存映射目标的键，路径组件不会为空字符串
+    TARGET = ''
+    
+    def __init__(self, path_mappings_str):
+        self.path_mappings_str = path_mappings_str
+        self.root = {}
+        self.rule_count = 0
+        
+        for mapping in (path_mappings_str or '').split(','):
             mapping = mapping.strip()
-            if not mapping or '=' not in mapping:
+            if not mapping:
+                continue
+            if '=' not in mapping:
+                logger.warning(f"忽略无效的路径映射配置: {mapping}")
                 continue
-                
             container_path, nas_path = mapping.split('=', 1)
             container_path = container_path.strip()
             nas_path = nas_path.strip()
+            if not container_path or not nas_path:
+                logger.warning(f"忽略无效的路径映射配置: {mapping}")
+                continue
             
             # 规范化路径，确保一致的格式
-            container_path = os.path.normpath(container_path)
-            nas_path = os.path.normpath(nas_path)
-            
-            path_mappings[container_path] = nas_path
-    except Exception as e:
-        logger.error(f"解析路径映射配置出错: {str(e)} - {path_mappings_str}")
+            node = self.root
+            for part in self.split_path(os.path.normpath(container_path)):
+                node = node.setdefault(part, {})
+            node[self.TARGET] = os.path.normpath(nas_path)
+            self.rule_count += 1
+    
+    # 将规范化后的路径拆分为组件，绝对路径以 os.sep 作为第一个组件
+    @staticmethod
+    def split_path(norm_path):
+        parts = [part for part in norm_path.split(os.sep) if part]
+        if norm_path.startswith(os.sep):
+            parts.insert(0, os.sep)
+        return parts
+    
+    # 映射一个已规范化的路径，没有匹配的规则时原样返回
+    def map(self, norm_path):
+        if not self.rule_count:
+            return norm_path
+        
+        parts = self.split_path(norm_path)
+        node = self.root
+        target = node.get(self.TARGET)
+        depth = 0
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if self.TARGET in node:
+                target = node[self.TARGET]
+                depth = i + 1
+        
+        if target is None:
+            return norm_path
+        if depth >= len(parts):
+            return target
+        return os.path.join(target, *parts[depth:])
+
+# 编译并缓存路径映射配置，相同的配置只解析一次
+@functools.lru_cache(maxsize=64)
+def compile_path_mappings(path_mappings_str):
+    return PathMapper(path_mappings_str)
+
+# 应用路径映射，将下载器路径转换为NAS路径
+def apply_path_mapping(file_path, path_mappings_str):
+    if not path_mappings_str:
         return file_path
     
-    # 遍历所有映射规则尝试替换
-    for container_path, nas_path in path_mappings.items():
-        try:
-            # 检查路径前缀
-            if norm_path.startswith(container_path):
-                # 替换路径前缀
-                relative_path = os.path.relpath(norm_path, container_path)
-                if relative_path == '.':  # 如果是完全匹配，没有相对路径
-                    mapped_path = nas_path
-                else:
-                    mapped_path = os.path.join(nas_path, relative_path)
-                
-                logger.debug(f"路径映射: {norm_path} -> {mapped_path}")
-                return mapped_path
-            # 如果是根目录映射特殊处理
-            elif container_path == '/' and norm_path.startswith('/'):
-                mapped_path = os.path.join(nas_path, norm_path[1:])
-                logger.debug(f"根目录映射: {norm_path} -> {mapped_path}")
-                return mapped_path
-        except Exception as e:
-            logger.error(f"应用路径映射时出错: {str(e)} - 路径: {norm_path}, 映射: {container_path}={nas_path}")
+    norm_path = os.path.normpath(file_path)
+    mapped_path = compile_path_mappings(path_mappings_str).map(norm_path)
+    if mapped_path == norm_path:
+        # 如果没有找到匹配的映射，返回原始路径
+        return file_path
+    logger.debug(f"路径映射: {norm_path} -> {mapped_path}")
+    return mapped_path
+
+# 种子文件列表缓存：同一个infohash的文件列表不会变化，所有下载器共享，按 torrent_hash 保存每个文件的相对路径和大小
+class TorrentFileCache:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.closed = False
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS torrents ("
+            "torrent_hash TEXT PRIMARY KEY, file_count INTEGER NOT NULL, updated_at INTEGER NOT NULL) WITHOUT ROWID")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS torrent_files ("
+            "torrent_hash TEXT NOT NULL, file_index INTEGER NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+            "PRIMARY KEY (torrent_hash, file_index)) WITHOUT ROWID")
+        self.conn.commit()
+    
+    # 批量查询文件列表，返回 {torrent_hash: [[文件名, 大小], ...]}，未缓存的种子不在结果中
+    def get_many(self, torrent_hashes):
+        result = {}
+        torrent_hashes = [h for h in torrent_hashes if h]
+        with self.lock:
+            if self.closed:
+                return result
+            for i in range(0, len(torrent_hashes), 500):
+                chunk = torrent_hashes[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for (torrent_hash,) in self.conn.execute(
+                        f"SELECT torrent_hash FROM torrents WHERE torrent_hash IN ({placeholders})", chunk):
+                    result[torrent_hash] = []
+                for torrent_hash, name, size in self.conn.execute(
+                        f"SELECT torrent_hash, name, size FROM torrent_files WHERE torrent_hash IN ({placeholders}) "
+                        f"ORDER BY torrent_hash, file_index", chunk):
+                    result[torrent_hash].append([name, size])
+        return result
+    
+    # 保存一个种子的文件列表，缓存关闭后(例如超时的下载器线程仍在运行)直接忽略
+    def put(self, torrent_hash, files):
+        if not torrent_hash:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            self.conn.execute("DELETE FROM torrent_files WHERE torrent_hash = ?", (torrent_hash,))
+            self.conn.execute("INSERT OR REPLACE INTO torrents (torrent_hash, file_count, updated_at) VALUES (?, ?, ?)",
+                              (torrent_hash, len(files), int(time.time())))
+            self.conn.executemany("INSERT INTO torrent_files (torrent_hash, file_index, name, size) VALUES (?, ?, ?, ?)",
+                                  ((torrent_hash, i, name, size) for i, (name, size) in enumerate(files)))
+    
+    # 删除已经不在任何下载器中的种子，返回删除的种子数
+    def expire(self, live_hashes):
+        with self.lock:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_hashes (torrent_hash TEXT PRIMARY KEY) WITHOUT ROWID")
+            self.conn.execute("DELETE FROM live_hashes")
+            self.conn.executemany("INSERT OR IGNORE INTO live_hashes (torrent_hash) VALUES (?)", ((h,) for h in live_hashes if h))
+            removed = self.conn.execute(
+                "DELETE FROM torrents WHERE torrent_hash NOT IN (SELECT torrent_hash FROM live_hashes)").rowcount
+            self.conn.execute("DELETE FROM torrent_files WHERE torrent_hash NOT IN (SELECT torrent_hash FROM live_hashes)")
+            self.conn.commit()
+        return removed
+    
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.conn.commit()
+            self.conn.close()
+
+# 做种文件记录：下载器和种子级别的信息各只保存一份，由该种子的所有文件按引用共享
+# 下载器信息：类型、配置中的ID、地址和路径映射配置(便于排查路径映射问题)
+class ClientInfo:
+    __slots__ = ('client_type', 'client_id', 'client_host', 'path_mapping')
+    
+    def __init__(self, client_type, client_id, client_host, path_mapping=''):
+        self.client_type = client_type
+        self.client_id = client_id
+        self.client_host = client_host
+        self.path_mapping = path_mapping
+
+# 种子信息：所属下载器、名称、哈希、状态和保存位置
+class TorrentInfo:
+    __slots__ = ('client', 'name', 'hash', 'state', 'save_path')
+    
+    def __init__(self, client, name, torrent_hash, state, save_path):
+        self.client = client
+        self.name = name
+        self.hash = torrent_hash
+        self.state = state
+        self.save_path = save_path
+
+# 单个做种文件：映射后的规范化路径、下载器中的原始路径、文件大小和所属种子
+# 文件名和可读大小只在写报告时才计算
+class SeedingFile:
+    __slots__ = ('file_path', 'original_path', 'file_size', 'torrent')
+    
+    def __init__(self, file_path, original_path, file_size, torrent):
+        self.file_path = file_path
+        self.original_path = original_path
+        self.file_size = file_size
+        self.torrent = torrent
+    
+    @property
+    def client(self):
+        return self.torrent.client
+    
+    @property
+    def file_name(self):
+        return os.path.basename(self.file_path)
+    
+    @property
+    def file_size_human(self):
+        return humanize.naturalsize(self.file_size, binary=True) if self.file_size else "未知"
+
+# 获取单个下载器的做种文件，fetch_stats 中记录请求统计和获取结果
+def get_client_seeding_files(config, client_id, fetch_stats, sync_states, file_cache=None, connections=None,
+                             cancel_event=None):
+    client_config = config[client_id]
+    client_type = client_config.get('type', '').lower()
+    start_time = time.monotonic()
+    if connections is None:
+        connections = {}
+    
+    if client_type == 'qbittorrent':
+        logger.info(f"获取qBittorrent({client_id})做种文件")
+        sync_state = None
+        sync_state_file = None
+        if client_config.get('sync_mode', 'false').lower() in ('true', 'yes', '1', 'on'):
+            # 增量同步模式：优先使用内存中的快照，否则从磁盘恢复
+            sync_state_file = get_qbittorrent_sync_state_file(get_state_directory(config), client_id)
+            client_host = f"{client_config.get('host', '')}:{client_config.get('port', '')}"
+            if sync_states.get(client_id, {}).get('client_host') != client_host:
+                sync_states[client_id] = load_qbittorrent_sync_state(sync_state_file, client_host)
+            sync_state = sync_states[client_id]
+        max_concurrency = max(1, int(client_config.get('max_concurrency', 1)))
+        connection = get_downloader_connection(connections, client_id, client_config, max_concurrency)
+        bytes_before = connection.bytes_received
+        client_files = get_qbittorrent_files_from_config(
+            client_config, client_id, fetch_stats, sync_state, sync_state_file, file_cache, connection, cancel_event)
+    elif client_type == 'transmission':
+        logger.info(f"获取Transmission({client_id})做种文件")
+        connection = get_downloader_connection(connections, client_id, client_config)
+        bytes_before = connection.bytes_received
+        client_files = get_transmission_files_from_config(
+            client_config, client_id, fetch_stats, file_cache, connection, cancel_event)
+    else:
+        logger.warning(f"不支持的下载器类型: {client_type} (客户端 {client_id})")
+        fetch_stats['status'] = '不支持的类型'
+        return []
     
-    # 如果没有找到匹配的映射，返回原始路径
-    return file_path
+    fetch_stats['elapsed'] = time.monotonic() - start_time
+    fetch_stats['http_bytes'] = connection.bytes_received - bytes_before
+    fetch_stats['file_count'] = len(client_files)
+    fetch_stats['status'] = '成功' if fetch_stats.get('success') else '失败'
+    logger.info(f"{client_id}做种文件数: {len(client_files)}, 耗时 {fetch_stats['elapsed']:.2f} 秒")
+    return client_files
 
-# 获取下载器中的做种文件列表
-def get_seeding_files(config):
+# 获取下载器中的做种文件列表，返回 [SeedingFile]
+# sync_states 为各qBittorrent下载器的增量同步快照，由守护进程主循环保存，跨多次检查复用
+# client_stats 用于返回各下载器的获取结果，便于在运行摘要中报告失败或超时的下载器
+# connections 为各下载器的长连接，由守护进程主循环保存，避免每次检查都重新登录和握手
+def get_seeding_files(config, sync_states=None, client_stats=None, connections=None):
     if 'downloader' not in config:
         logger.error("配置文件中缺少 'downloader' 部分")
-        return [], []
+        return []
     
     seeding_files = []
-    seeding_torrents = []  # 新增保存种子详细信息
+    if sync_states is None:
+        sync_states = {}
+    if client_stats is None:
+        client_stats = {}
+    close_connections = connections is None
+    if connections is None:
+        connections = {}
+    
+    # 共享的种子文件列表缓存
+    file_cache = None
+    if config['general'].get('file_cache', 'false').lower() in ('true', 'yes', '1', 'on'):
+        cache_path = os.path.join(get_state_directory(config), 'torrent_file_cache.db')
+        try:
+            file_cache = TorrentFileCache(cache_path)
+            logger.info(f"使用种子文件列表缓存: {cache_path}")
+        except Exception as e:
+            logger.error(f"打开种子文件列表缓存出错: {cache_path}, 错误: {str(e)}")
     
     # 检查是否使用新版多下载器配置
     if 'enabled_clients' in config['downloader']:
@@ -246,282 +476,836 @@ def get_seeding_files(config):
         client_ids = [client_id.strip() for client_id in config['downloader']['enabled_clients'].split(',')]
         logger.info(f"使用多下载器配置，启用的下载器: {client_ids}")
         
+        valid_client_ids = []
         for client_id in client_ids:
             if client_id and client_id in config:
-                client_config = config[client_id]
-                client_type = client_config.get('type', '').lower()
-                
-                if client_type == 'qbittorrent':
-                    logger.info(f"获取qBittorrent({client_id})做种文件")
-                    client_files, client_torrents = get_qbittorrent_files_from_config(client_config, client_id)
-                    logger.info(f"{client_id}做种文件数: {len(client_files)}")
-                    seeding_files.extend(client_files)
-                    seeding_torrents.extend(client_torrents)
-                    
-                elif client_type == 'transmission':
-                    logger.info(f"获取Transmission({client_id})做种文件")
-                    client_files, client_torrents = get_transmission_files_from_config(client_config, client_id)
-                    logger.info(f"{client_id}做种文件数: {len(client_files)}")
-                    seeding_files.extend(client_files)
-                    seeding_torrents.extend(client_torrents)
-                    
-                else:
-                    logger.warning(f"不支持的下载器类型: {client_type} (客户端 {client_id})")
+                if client_id not in valid_client_ids:
+                    valid_client_ids.append(client_id)
             else:
                 logger.warning(f"配置文件中缺少客户端配置: {client_id}")
+        
+        # 所有下载器并发获取，每个下载器有各自的截止时间
+        start_time = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max(1, len(valid_client_ids)))
+        futures = {}
+        cancel_events = {}
+        timed_out_futures = []
+        for client_id in valid_client_ids:
+            client_stats[client_id] = {'status': '进行中'}
+            cancel_events[client_id] = threading.Event()
+            futures[client_id] = executor.submit(
+                get_client_seeding_files, config, client_id, client_stats[client_id], sync_states, file_cache, connections,
+                cancel_events[client_id])
+        
+        # 按配置顺序合并结果，保证输出顺序稳定
+        for client_id in valid_client_ids:
+            deadline = float(config[client_id].get('deadline', 1800))
+            remaining = max(0.0, deadline - (time.monotonic() - start_time)) if deadline > 0 else None
+            try:
+                client_files = futures[client_id].result(timeout=remaining)
+            except FuturesTimeoutError:
+                logger.error(f"下载器 {client_id} 未在截止时间 {deadline:.0f} 秒内完成，标记为失败")
+                client_stats[client_id] = {'status': '超时', 'success': False, 'elapsed': time.monotonic() - start_time}
+                # 通知超时线程停止，并关闭其连接使后续请求立即失败；
+                # 超时线程可能仍在修改同步快照，丢弃内存中的快照和连接，下次重新建立
+                cancel_events[client_id].set()
+                connection = connections.pop(client_id, None)
+                if connection is not None:
+                    connection.close()
+                sync_states.pop(client_id, None)
+                timed_out_futures.append(futures[client_id])
+                continue
+            except Exception as e:
+                logger.error(f"获取下载器 {client_id} 做种文件时出错: {str(e)}")
+                client_stats[client_id] = {'status': '失败', 'success': False, 'elapsed': time.monotonic() - start_time}
+                continue
+            seeding_files.extend(client_files)
+        
+        # 超时线程在下一个检查点退出，正在进行的请求最多等到读取超时；短暂等待它们结束后再关闭共享的缓存，
+        # 仍未结束的线程不再写入缓存(缓存关闭后写入会被忽略)和同步状态
+        if timed_out_futures:
+            _, not_done = wait_futures(timed_out_futures, timeout=10)
+            if not_done:
+                logger.warning(f"{len(not_done)} 个超时的下载器线程仍在等待请求返回，将在请求结束后退出")
+        executor.shutdown(wait=False, cancel_futures=True)
+        
+        failed_clients = [client_id for client_id, stats in client_stats.items() if not stats.get('success')]
+        if failed_clients:
+            failed_summary = ', '.join(f"{client_id}({client_stats[client_id].get('status', '失败')})" for client_id in failed_clients)
+            logger.warning(f"以下下载器获取失败: {failed_summary}")
+        
+        # 只有全部下载器都获取成功时才清理缓存，避免某个下载器临时不可用时误删
+        if file_cache is not None and client_stats:
+            if not failed_clients:
+                live_hashes = set()
+                for stats in client_stats.values():
+                    live_hashes.update(stats.get('torrent_hashes', ()))
+                try:
+                    removed = file_cache.expire(live_hashes)
+                    logger.info(f"种子文件列表缓存已清理 {removed} 个不存在的种子")
+                except Exception as e:
+                    logger.warning(f"清理种子文件列表缓存出错: {str(e)}")
+            else:
+                logger.info("部分下载器获取失败，跳过清理种子文件列表缓存")
     else:
         # 兼容旧版配置
         client_type = config['downloader'].get('client_type', '').lower()
         logger.info(f"使用旧版下载器配置，下载器类型: {client_type}")
         
         if client_type == 'qbittorrent':
-            seeding_files, seeding_torrents = get_qbittorrent_files(config)
+            seeding_files = get_qbittorrent_files(config)
         elif client_type == 'transmission':
-            seeding_files, seeding_torrents = get_transmission_files(config)
+            seeding_files = get_transmission_files(config)
         elif client_type == 'both':
             # 同时获取两种下载器的做种文件
-            qb_files, qb_torrents = get_qbittorrent_files(config)
+            qb_files = get_qbittorrent_files(config)
             logger.info(f"qBittorrent做种文件数: {len(qb_files)}")
             
-            tr_files, tr_torrents = get_transmission_files(config)
+            tr_files = get_transmission_files(config)
             logger.info(f"Transmission做种文件数: {len(tr_files)}")
             
-            # 合并文件列表和种子信息
+            # 合并文件列表
             seeding_files = qb_files + tr_files
-            seeding_torrents = qb_torrents + tr_torrents
         else:
             logger.error(f"不支持的下载器类型: {client_type}")
     
-    return seeding_files, seeding_torrents
+    if file_cache is not None:
+        file_cache.close()
+    if close_connections:
+        for connection in connections.values():
+            connection.close()
+    
+    return seeding_files
+
+# 流式解析HTTP响应中的JSON数组，逐个返回数组元素，缓冲区大小只与单个元素相关
+# key 为空时解析顶层数组，否则解析第一个名为 key 的字段对应的数组
+def iter_json_array(response, key=None, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buffer = ''
+    pos = 0
+    eof = False
+    
+    # 读取更多数据到缓冲区，返回是否读到了新数据
+    def read_more():
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer = buffer[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        return True
+    
+    # 定位数组起始位置
+    start_pattern = re.compile(r'\s*\[' if key is None else r'"' + re.escape(key) + r'"\s*:\s*\[')
+    while True:
+        match = start_pattern.match(buffer, pos) if key is None else start_pattern.search(buffer, pos)
+        if match:
+            pos = match.end()
+            break
+        if key is not None:
+            # 只保留可能包含字段名开头的尾部数据
+            pos = max(pos, len(buffer) - len(key) - 16)
+        if not read_more():
+            raise ValueError(f"响应中未找到JSON数组{f': {key}' if key else ''}")
+    
+    while True:
+        # 跳过空白和分隔符
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) or not read_more():
+                break
+        if pos >= len(buffer):
+            raise ValueError("JSON数组未正常结束")
+        if buffer[pos] == ']':
+            return
+        
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            # 元素后面必须是分隔符，否则可能被截断(如数字"7."只解析出了"7")，需要读取更多数据确认
+            if end == len(buffer) or buffer[end] not in ' \t\r\n,]':
+                raise ValueError("JSON数组元素不完整")
+        except ValueError:
+            # 元素不完整，至少读取与当前未解析数据等量的新数据后重试，避免大元素被反复解析
+            pending = len(buffer) - pos
+            if not read_more():
+                raise
+            while not eof and len(buffer) - pos < pending * 2:
+                read_more()
+            continue
+        pos = end
+        yield item
+
+# 为未显式指定超时的请求设置默认连接/读取超时
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+    
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+# 下载器连接：保持HTTP长连接池、gzip压缩、qBittorrent的SID cookie和Transmission的会话ID，守护进程模式下跨多次检查复用
+class DownloaderConnection:
+    def __init__(self, client_id, client_config, pool_size=10):
+        self.client_id = client_id
+        self.client_type = client_config.get('type', '').lower()
+        self.host = client_config.get('host', '')
+        self.port = client_config.get('port', '')
+        self.username = client_config.get('username', '')
+        self.password = client_config.get('password', '')
+        self.pool_size = max(1, pool_size)
+        self.config_key = self.make_config_key(client_config, self.pool_size)
+        self.base_url = f"http://{self.host}:{self.port}"
+        
+        # 设置连接超时(connect_timeout)、读取超时(read_timeout)和连接池大小
+        connect_timeout = float(client_config.get('connect_timeout', 10))
+        read_timeout = float(client_config.get('read_timeout', 120))
+        self.session = requests.Session()
+        adapter = TimeoutHTTPAdapter(timeout=(connect_timeout, read_timeout), pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        if self.client_type == 'transmission':
+            self.session.auth = (self.username, self.password)
+        
+        self.lock = threading.Lock()
+        self.login_generation = 0
+        self.logged_in = False
+        self.transmission_session_id = None
+        # 累计接收的响应体字节数，按 Content-Length 统计(压缩传输时为压缩后的大小)，分块传输的响应不计入
+        self.stats_lock = threading.Lock()
+        self.bytes_received = 0
+        # 关闭后不再发送新的请求，超时的下载器线程中后续请求立即失败
+        self.closed = False
+    
+    # 影响连接的配置项，配置变化时需要重新建立连接
+    @staticmethod
+    def make_config_key(client_config, pool_size):
+        return tuple(client_config.get(key, '') for key in
+                     ('type', 'host', 'port', 'username', 'password', 'connect_timeout', 'read_timeout')) + (pool_size,)
+    
+    # 发送请求并记录请求次数、耗时和接收的字节数
+    def request(self, method, path, fetch_stats=None, **kwargs):
+        if self.closed:
+            raise RuntimeError(f"下载器连接已关闭 (客户端 {self.client_id})")
+        start_time = time.monotonic()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit():
+                with self.stats_lock:
+                    self.bytes_received += int(content_length)
+            return response
+        finally:
+            if fetch_stats is not None:
+                fetch_stats['http_calls'] = fetch_stats.get('http_calls', 0) + 1
+                fetch_stats['http_time'] = fetch_stats.get('http_time', 0.0) + time.monotonic() - start_time
+    
+    # 登录qBittorrent，成功后SID cookie保存在会话中
+    def qbittorrent_login(self, fetch_stats=None):
+        logger.info(f"尝试登录qBittorrent: {self.base_url}/api/v2/auth/login (客户端 {self.client_id})")
+        response = self.request('POST', '/api/v2/auth/login', fetch_stats,
+                                data={"username": self.username, "password": self.password})
+        if response.status_code != 200 or response.text.strip() == 'Fails.':
+            self.logged_in = False
+            raise RuntimeError(f"登录qBittorrent失败: {response.text}")
+        self.logged_in = True
+        self.login_generation += 1
+    
+    # 发送qBittorrent API请求，未登录时先登录，返回403时重新登录并重试一次
+    def qbittorrent_request(self, method, path, fetch_stats=None, **kwargs):
+        with self.lock:
+            if not self.logged_in:
+                self.qbittorrent_login(fetch_stats)
+            generation = self.login_generation
+        
+        response = self.request(method, path, fetch_stats, **kwargs)
+        if response.status_code == 403:
+            response.close()
+            with self.lock:
+                # 其他线程可能已经重新登录过
+                if generation == self.login_generation:
+                    logger.info(f"qBittorrent登录已失效，重新登录 (客户端 {self.client_id})")
+                    self.qbittorrent_login(fetch_stats)
+            response = self.request(method, path, fetch_stats, **kwargs)
+        return response
+    
+    # 发送Transmission RPC请求，返回409时更新会话ID并重试
+    def transmission_rpc(self, payload, fetch_stats=None, **kwargs):
+        url_path = '/transmission/rpc'
+        for _ in range(2):
+            headers = {}
+            if self.transmission_session_id:
+                headers['X-Transmission-Session-Id'] = self.transmission_session_id
+            response = self.request('POST', url_path, fetch_stats, json=payload, headers=headers, **kwargs)
+            if response.status_code != 409:
+                return response
+            response.close()
+            self.transmission_session_id = response.headers.get('X-Transmission-Session-Id')
+            logger.info(f"获取到新的Transmission会话ID (客户端 {self.client_id})")
+        return response
+    
+    def close(self):
+        self.closed = True
+        self.session.close()
+
+# 下载器超过截止时间后主线程会设置 cancel_event，获取线程在各阶段之间检查，尽快退出且不再写入缓存和同步状态
+def check_fetch_cancelled(cancel_event, client_id=''):
+    if cancel_event is not None and cancel_event.is_set():
+        raise RuntimeError(f"已超过截止时间，停止获取 (客户端 {client_id})")
+
+# 获取下载器连接，已存在且配置未变化时复用，否则新建
+def get_downloader_connection(connections, client_id, client_config, pool_size=10):
+    pool_size = max(1, pool_size)
+    connection = connections.get(client_id)
+    if connection is not None and connection.config_key == DownloaderConnection.make_config_key(client_config, pool_size):
+        return connection
+    if connection is not None:
+        logger.info(f"下载器配置已变化，重新建立连接 (客户端 {client_id})")
+        connection.close()
+    connection = DownloaderConnection(client_id, client_config, pool_size)
+    connections[client_id] = connection
+    return connection
 
-# 从配置获取qBittorrent做种文件
-def get_qbittorrent_files_from_config(client_config, client_id=''):
+# qBittorrent中视为正在做种的状态
+QBITTORRENT_SEEDING_STATES = ('uploading', 'stalledUP', 'forcedUP', 'queuedUP', 'checkingUP')
+
+# 获取单个qBittorrent种子的文件列表，返回 (文件列表或None, 请求耗时秒数)
+def fetch_qbittorrent_torrent_files(connection, torrent_hash, client_id=''):
+    start_time = time.monotonic()
+    try:
+        files_response = connection.qbittorrent_request('GET', '/api/v2/torrents/files', params={'hash': torrent_hash})
+        if files_response.status_code != 200:
+            logger.warning(f"获取种子文件列表失败: {torrent_hash} (客户端 {client_id})")
+            return None, time.monotonic() - start_time
+        return files_response.json(), time.monotonic() - start_time
+    except Exception as e:
+        logger.warning(f"获取种子文件列表出错: {torrent_hash}, 错误: {str(e)} (客户端 {client_id})")
+        return None, time.monotonic() - start_time
+
+# 批量获取qBittorrent种子的文件列表，按种子顺序逐个返回 (种子, 文件列表或None)
+def iter_qbittorrent_torrent_files(connection, torrents, max_concurrency, client_id='', fetch_stats=None,
+                                   cancel_event=None):
+    if fetch_stats is None:
+        fetch_stats = {}
+    check_fetch_cancelled(cancel_event, client_id)
+    
+    def fetch_files(torrent):
+        # 取消后跳过尚未开始的请求
+        if cancel_event is not None and cancel_event.is_set():
+            return None, 0.0
+        return fetch_qbittorrent_torrent_files(connection, torrent['hash'], client_id)
+    
+    # 并发模式下结果仍按种子顺序返回，保证去重顺序不变
+    if max_concurrency > 1:
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        file_results = executor.map(fetch_files, torrents)
+    else:
+        executor = None
+        file_results = map(fetch_files, torrents)
+    
+    try:
+        for torrent, (files, elapsed) in zip(torrents, file_results):
+            check_fetch_cancelled(cancel_event, client_id)
+            fetch_stats['file_list_calls'] = fetch_stats.get('file_list_calls', 0) + 1
+            fetch_stats['file_list_time'] = fetch_stats.get('file_list_time', 0.0) + elapsed
+            yield torrent, files
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+# 获取qBittorrent增量同步状态文件路径
+def get_qbittorrent_sync_state_file(state_dir, client_id):
+    return os.path.join(state_dir, f"qb_sync_{client_id or 'default'}.json")
+
+# 加载qBittorrent增量同步状态，文件不存在或内容无效时返回空状态
+def load_qbittorrent_sync_state(state_file, client_host):
+    empty_state = {'rid': 0, 'client_host': client_host, 'torrents': {}, 'files': {}}
+    if not os.path.exists(state_file):
+        return empty_state
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('client_host') != client_host:
+            logger.info(f"下载器地址已变化，忽略旧的同步状态: {state_file}")
+            return empty_state
+        state.setdefault('rid', 0)
+        state.setdefault('torrents', {})
+        state.setdefault('files', {})
+        logger.info(f"加载同步状态: {state_file}, rid: {state['rid']}, 种子数: {len(state['torrents'])}")
+        return state
+    except Exception as e:
+        logger.warning(f"读取同步状态文件出错: {state_file}, 错误: {str(e)}")
+        return empty_state
+
+# 原子方式保存JSON文件，避免写入中途失败留下损坏的文件；文件名以 .gz 结尾时使用gzip压缩
+def save_json_atomic(file_path, data):
+    tmp_path = f"{file_path}.tmp"
+    opener = gzip.open if file_path.endswith('.gz') else open
+    with opener(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, file_path)
+
+# 原子方式流式写入文本报告：逐行写入临时文件，完成后替换为正式文件，内存中不保留完整报告；
+# 文件名以 .gz 结尾时使用gzip压缩，写入中途出错时删除临时文件，不会留下不完整的报告
+def write_report_atomic(file_path, lines):
+    tmp_path = f"{file_path}.tmp"
+    opener = gzip.open if file_path.endswith('.gz') else open
+    try:
+        with opener(tmp_path, 'wt', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line)
+                f.write('\n')
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# 导出文件的字段，数值均为原始整数(字节数、整数秒时间戳)，字段顺序固定，新增字段只会追加在末尾
+NAS_EXPORT_FIELDS = ('file_path', 'size_bytes', 'ctime', 'mtime', 'extension', 'file_type', 'device', 'inode', 'nlink')
+SEEDING_EXPORT_FIELDS = ('file_path', 'original_path', 'size_bytes', 'torrent_hash', 'torrent_name', 'torrent_state',
+                         'save_path', 'client_id', 'client_type', 'client_host')
+
+def iter_nas_export_rows(nas_files):
+    for file_path, details in nas_files:
+        yield (file_path, details.size_bytes, details.ctime, details.mtime, details.extension, details.file_type,
+               details.device, details.inode, details.nlink)
+
+def iter_seeding_export_rows(seeding_files):
+    for file in seeding_files:
+        torrent = file.torrent
+        client = torrent.client
+        yield (file.file_path, file.original_path, file.file_size, torrent.hash, torrent.name, torrent.state,
+               torrent.save_path, client.client_id, client.client_type, client.client_host)
+
+# 将导出的行转换为文本行：jsonl 每行一个JSON对象，csv 首行为字段名
+def iter_export_lines(export_format, fields, rows):
+    if export_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row)), ensure_ascii=False)
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='')
+    writer.writerow(fields)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+# 按 export_formats 流式写出导出文件，exports 为 [(不含扩展名的路径, 字段, 返回行迭代器的函数)]
+def save_exports(exports, export_formats, suffix=''):
+    error_count = 0
+    for export_format in export_formats:
+        if export_format not in ('jsonl', 'csv'):
+            logger.warning(f"不支持的导出格式: {export_format}")
+            continue
+        for base_path, fields, make_rows in exports:
+            file_path = f"{base_path}.{export_format}{suffix}"
+            try:
+                write_report_atomic(file_path, iter_export_lines(export_format, fields, make_rows()))
+                logger.info(f"已导出: {file_path}")
+            except Exception as e:
+                logger.error(f"导出文件出错: {file_path}, 错误: {str(e)}")
+                error_count += 1
+    return error_count
+
+# 报告的汇总信息文件：与报告同名，扩展名为 .summary.json
+def get_report_summary_path(report_path):
+    if report_path.endswith('.gz'):
+        report_path = report_path[:-3]
+    return f"{os.path.splitext(report_path)[0]}.summary.json"
+
+# 通过 /api/v2/sync/maindata 增量更新qBittorrent种子快照，返回需要重新获取文件列表的种子哈希集合
+def sync_qbittorrent_torrents(connection, sync_state, client_id='', fetch_stats=None):
+    rid = sync_state.get('rid', 0)
+    logger.info(f"增量同步qBittorrent种子列表, rid: {rid} (客户端 {client_id})")
+    response = connection.qbittorrent_request('GET', '/api/v2/sync/maindata', fetch_stats, params={'rid': rid})
+    if response.status_code != 200:
+        raise RuntimeError(f"增量同步qBittorrent种子列表失败: {response.text}")
+    
+    data = response.json()
+    old_torrents = sync_state.get('torrents', {})
+    
+    # 只保留后续需要的字段
+    def pick_fields(torrent):
+        return {key: torrent[key] for key in ('name', 'save_path', 'state') if key in torrent}
+    
+    if data.get('full_update'):
+        # 完整更新：服务器返回全部种子，与本地快照对比得出变化
+        new_torrents = {torrent_hash: pick_fields(torrent) for torrent_hash, torrent in data.get('torrents', {}).items()}
+    else:
+        # 增量更新：只包含变化的字段
+        new_torrents = {torrent_hash: dict(torrent) for torrent_hash, torrent in old_torrents.items()}
+        for torrent_hash, changes in data.get('torrents', {}).items():
+            new_torrents.setdefault(torrent_hash, {}).update(pick_fields(changes))
+        for torrent_hash in data.get('torrents_removed', []):
+            new_torrents.pop(torrent_hash, None)
+    
+    added = [h for h in new_torrents if h not in old_torrents]
+    removed = [h for h in old_torrents if h not in new_torrents]
+    
+    # 只有保存路径变化的种子必须重新获取文件列表；新增或只有状态变化(例如重新进入做种状态)的种子
+    # 文件列表不会变化，先查文件列表缓存和增量同步快照，都没有时才获取
+    refetch = set()
+    changed_count = 0
+    for torrent_hash, torrent in new_torrents.items():
+        old_torrent = old_torrents.get(torrent_hash)
+        if old_torrent is None:
+            continue
+        was_seeding = old_torrent.get('state') in QBITTORRENT_SEEDING_STATES
+        is_seeding = torrent.get('state') in QBITTORRENT_SEEDING_STATES
+        if old_torrent.get('save_path') != torrent.get('save_path'):
+            refetch.add(torrent_hash)
+            changed_count += 1
+        elif is_seeding and not was_seeding:
+            changed_count += 1
+    
+    # 已删除的种子不再保留文件列表
+    files = sync_state.get('files', {})
+    for torrent_hash in removed:
+        files.pop(torrent_hash, None)
+    
+    sync_state['rid'] = data.get('rid', 0)
+    sync_state['torrents'] = new_torrents
+    sync_state['files'] = files
+    
+    logger.info(f"增量同步完成: {'完整更新' if data.get('full_update') else '增量更新'}, 新增 {len(added)} 个, "
+                f"删除 {len(removed)} 个, 状态变化 {changed_count} 个种子, 新rid: {sync_state['rid']} (客户端 {client_id})")
+    return refetch
+
+# 从配置获取qBittorrent做种文件，返回 [SeedingFile]
+def get_qbittorrent_files_from_config(client_config, client_id='', fetch_stats=None, sync_state=None, sync_state_file=None, file_cache=None,
+                                      connection=None, cancel_event=None):
     host = client_config.get('host', '')
     port = client_config.get('port', '')
-    username = client_config.get('username', '')
-    password = client_config.get('password', '')
     
     # 获取此下载器的路径映射配置
     path_mappings_str = client_config.get('path_mappings', '')
     if path_mappings_str:
         logger.info(f"下载器 {client_id} 配置了路径映射: {path_mappings_str}")
+    path_mapper = compile_path_mappings(path_mappings_str)
     
     if not host or not port:
         logger.error(f"qBittorrent配置不完整，缺少host或port (客户端 {client_id})")
-        return [], []
+        return []
+    
+    # 并发获取文件列表的最大线程数，1表示逐个获取
+    max_concurrency = max(1, int(client_config.get('max_concurrency', 1)))
     
-    base_url = f"http://{host}:{port}"
-    session = requests.Session()
+    # 是否流式解析种子列表
+    stream_json = client_config.get('stream_json', 'true').lower() in ('true', 'yes', '1', 'on')
+    
+    # 请求统计信息
+    if fetch_stats is None:
+        fetch_stats = {}
+    fetch_stats.update({'http_calls': 0, 'http_time': 0.0, 'file_list_calls': 0, 'file_list_time': 0.0})
+    
+    # 连接池大小与并发数一致，避免并发请求时连接被丢弃
+    if connection is None:
+        connection = DownloaderConnection(client_id, client_config, max_concurrency)
     
     try:
-        # 登录
-        login_url = f"{base_url}/api/v2/auth/login"
-        logger.info(f"尝试登录qBittorrent: {login_url} (客户端 {client_id})")
-        response = session.post(login_url, data={"username": username, "password": password})
-        if response.status_code != 200:
-            logger.error(f"登录qBittorrent失败: {response.text} (客户端 {client_id})")
-            return [], []
-        
-        # 获取种子列表
-        torrents_url = f"{base_url}/api/v2/torrents/info"
-        logger.info(f"获取qBittorrent种子列表: {torrents_url} (客户端 {client_id})")
-        response = session.get(torrents_url)
-        if response.status_code != 200:
-            logger.error(f"获取qBittorrent种子列表失败: {response.text} (客户端 {client_id})")
-            return [], []
-        
-        torrents = response.json()
-        logger.info(f"找到 {len(torrents)} 个qBittorrent种子 (客户端 {client_id})")
         seeding_files = []
-        seeding_torrents = []
+        client_info = ClientInfo('qBittorrent', client_id, f"{host}:{port}", path_mappings_str)
+        fetch_start_time = time.monotonic()
+        refetch = set()
         
-        # 仅处理正在做种和活动中的种子
-        active_torrents = [t for t in torrents if t.get('state', '') in ['uploading', 'stalledUP', 'forcedUP', 'queuedUP', 'checkingUP']]
-        logger.info(f"其中 {len(active_torrents)} 个正在做种 (客户端 {client_id})")
+        if sync_state is not None:
+            # 增量同步模式：只为保存路径变化的种子，以及文件列表未缓存的新增或重新做种的种子获取文件列表
+            refetch = sync_qbittorrent_torrents(connection, sync_state, client_id, fetch_stats)
+            fetch_stats['torrent_hashes'] = set(sync_state['torrents'])
+            active_torrents = [dict(torrent, hash=torrent_hash) for torrent_hash, torrent in sync_state['torrents'].items()
+                               if torrent.get('state', '') in QBITTORRENT_SEEDING_STATES]
+            logger.info(f"共 {len(sync_state['torrents'])} 个qBittorrent种子，其中 {len(active_torrents)} 个正在做种 (客户端 {client_id})")
+        else:
+            # 获取种子列表
+            logger.info(f"获取qBittorrent种子列表: {connection.base_url}/api/v2/torrents/info (客户端 {client_id})")
+            response = connection.qbittorrent_request('GET', '/api/v2/torrents/info', fetch_stats, stream=stream_json)
+            if response.status_code != 200:
+                logger.error(f"获取qBittorrent种子列表失败: {response.text} (客户端 {client_id})")
+                return []
+            
+            # 流式模式下逐个解析种子，边解析边筛选，只保留做种种子需要的字段
+            torrents = iter_json_array(response) if stream_json else response.json()
+            all_hashes = set()
+            active_torrents = []
+            with response:
+                for torrent in torrents:
+                    all_hashes.add(torrent['hash'])
+                    # 仅处理正在做种和活动中的种子
+                    if torrent.get('state', '') in QBITTORRENT_SEEDING_STATES:
+                        active_torrents.append({key: torrent.get(key, '') for key in ('hash', 'name', 'save_path', 'state')})
+            del torrents
+            fetch_stats['torrent_hashes'] = all_hashes
+            logger.info(f"找到 {len(all_hashes)} 个qBittorrent种子 (客户端 {client_id})")
+            logger.info(f"其中 {len(active_torrents)} 个正在做种 (客户端 {client_id})")
+        
+        # 已知的文件列表：优先使用共享的文件列表缓存，其次使用增量同步快照
+        if file_cache is not None:
+            known_files = file_cache.get_many([t['hash'] for t in active_torrents])
+            if sync_state is not None:
+                sync_state['files'] = {}
+        elif sync_state is not None:
+            known_files = sync_state['files']
+        else:
+            known_files = {}
+        
+        # 只为未知或需要刷新的种子获取文件列表
+        to_fetch = [t for t in active_torrents if t['hash'] in refetch or t['hash'] not in known_files]
+        to_fetch_hashes = {t['hash'] for t in to_fetch}
+        logger.info(f"需要获取文件列表的种子: {len(to_fetch)} 个，已缓存: {len(active_torrents) - len(to_fetch)} 个，"
+                    f"并发数: {max_concurrency} (客户端 {client_id})")
+        
+        def iter_torrent_files():
+            fetched = iter_qbittorrent_torrent_files(connection, to_fetch, max_concurrency, client_id, fetch_stats,
+                                                     cancel_event)
+            for torrent in active_torrents:
+                check_fetch_cancelled(cancel_event, client_id)
+                torrent_hash = torrent['hash']
+                if torrent_hash not in to_fetch_hashes:
+                    yield torrent, known_files.get(torrent_hash)
+                    continue
+                
+                # to_fetch 与 active_torrents 顺序一致，依次取出获取结果
+                _, files = next(fetched)
+                if files is not None:
+                    files = [[file.get('name', ''), file.get('size', 0)] for file in files]
+                    if file_cache is not None:
+                        file_cache.put(torrent_hash, files)
+                    elif sync_state is not None:
+                        sync_state['files'][torrent_hash] = files
+                elif sync_state is not None:
+                    sync_state['files'].pop(torrent_hash, None)
+                yield torrent, files
         
         # 用于去重的集合
         unique_paths = set()
         
-        for torrent in active_torrents:
-            # 获取种子的文件列表
-            torrent_hash = torrent['hash']
-            content_url = f"{base_url}/api/v2/torrents/files?hash={torrent_hash}"
-            files_response = session.get(content_url)
-            if files_response.status_code != 200:
-                logger.warning(f"获取种子文件列表失败: {torrent_hash} (客户端 {client_id})")
+        for torrent, files in iter_torrent_files():
+            if files is None:
                 continue
             
-            files = files_response.json()
             save_path = torrent.get('save_path', '')
-            torrent_name = torrent.get('name', '')
+            torrent_info = TorrentInfo(client_info, torrent.get('name', ''), torrent['hash'],
+                                       torrent.get('state', '未知'), save_path)
             
-            for file in files:
-                file_name = file.get('name', '')
+            for file_name, file_size in files:
                 file_path = os.path.normpath(os.path.join(save_path, file_name))
-                file_size = file.get('size', 0)
                 
                 # 保存原始路径用于参考
                 original_path = file_path
                 
-                # 应用路径映射
-                mapped_file_path = apply_path_mapping(file_path, path_mappings_str)
-                
-                # 确保路径规范化
-                mapped_file_path = os.path.normpath(mapped_file_path)
+                # 应用路径映射，结果已经是规范化路径
+                mapped_file_path = path_mapper.map(file_path)
                 
                 # 记录映射前后的路径，便于调试
                 if mapped_file_path != file_path:
-                    logger.info(f"文件路径映射: {file_path} -> {mapped_file_path} (客户端 {client_id})")
+                    logger.debug(f"文件路径映射: {file_path} -> {mapped_file_path} (客户端 {client_id})")
                 
                 # 去重检查
                 if mapped_file_path not in unique_paths:
                     unique_paths.add(mapped_file_path)
-                    seeding_files.append(mapped_file_path)
-                    
-                    # 收集种子信息
-                    seeding_torrents.append({
-                        'file_path': mapped_file_path,
-                        'original_path': original_path,  # 保存原始路径，用于调试
-                        'file_name': os.path.basename(mapped_file_path),
-                        'file_size': file_size,
-                        'file_size_human': humanize.naturalsize(file_size, binary=True) if file_size else "未知",
-                        'torrent_name': torrent_name,
-                        'torrent_hash': torrent_hash,
-                        'torrent_state': torrent.get('state', '未知'),
-                        'save_path': save_path,
-                        'client_type': 'qBittorrent',
-                        'client_id': client_id,
-                        'client_host': f"{host}:{port}",
-                        'path_mapping': path_mappings_str  # 添加路径映射配置，便于排查
-                    })
+                    # 保存原始路径用于调试，种子和下载器信息按引用共享
+                    seeding_files.append(SeedingFile(mapped_file_path, original_path, file_size, torrent_info))
+        
+        fetch_elapsed = time.monotonic() - fetch_start_time
+        fetch_stats['http_calls'] += fetch_stats['file_list_calls']
+        fetch_stats['http_time'] += fetch_stats['file_list_time']
+        logger.info(f"获取文件列表完成: 共 {fetch_stats['file_list_calls']} 次请求, 请求累计耗时 {fetch_stats['file_list_time']:.2f} 秒, "
+                    f"实际耗时 {fetch_elapsed:.2f} 秒 (客户端 {client_id})")
         
+        # 保存同步状态，容器重启后无需完整重新同步；超时后不再保存，避免覆盖下一次检查的状态
+        check_fetch_cancelled(cancel_event, client_id)
+        if sync_state is not None and sync_state_file:
+            try:
+                save_json_atomic(sync_state_file, sync_state)
+                logger.info(f"同步状态已保存: {sync_state_file} (客户端 {client_id})")
+            except Exception as e:
+                logger.warning(f"保存同步状态出错: {sync_state_file}, 错误: {str(e)} (客户端 {client_id})")
+        
+        fetch_stats['success'] = True
         logger.info(f"qBittorrent做种文件总数: {len(seeding_files)} (客户端 {client_id})")
-        return seeding_files, seeding_torrents
+        return seeding_files
     
     except Exception as e:
+        if cancel_event is not None and cancel_event.is_set():
+            logger.warning(f"已超过截止时间，停止获取qBittorrent做种文件 (客户端 {client_id})")
+            return []
         logger.error(f"获取qBittorrent做种文件时出错: {str(e)} (客户端 {client_id})")
         import traceback
         logger.error(traceback.format_exc())
-        return [], []
+        return []
+
+# 逐个解析Transmission返回的种子，兼容table格式(首行为字段名的二维数组)和普通对象格式
+def iter_transmission_torrents(torrents):
+    keys = None
+    for torrent in torrents:
+        if isinstance(torrent, list):
+            if keys is None:
+                keys = torrent
+                continue
+            yield dict(zip(keys, torrent))
+        else:
+            yield torrent
 
-# 从配置获取Transmission做种文件
-def get_transmission_files_from_config(client_config, client_id=''):
+# 从配置获取Transmission做种文件，返回 [SeedingFile]
+def get_transmission_files_from_config(client_config, client_id='', fetch_stats=None, file_cache=None, connection=None,
+                                       cancel_event=None):
     host = client_config.get('host', '')
     port = client_config.get('port', '')
-    username = client_config.get('username', '')
-    password = client_config.get('password', '')
     
     # 获取此下载器的路径映射配置
     path_mappings_str = client_config.get('path_mappings', '')
     if path_mappings_str:
         logger.info(f"下载器 {client_id} 配置了路径映射: {path_mappings_str}")
+    path_mapper = compile_path_mappings(path_mappings_str)
     
     if not host or not port:
         logger.error(f"Transmission配置不完整，缺少host或port (客户端 {client_id})")
-        return [], []
+        return []
+    
+    # 第二阶段每批获取详细信息和文件列表的种子数
+    batch_size = max(1, int(client_config.get('batch_size', 500)))
+    
+    # 是否流式解析种子列表
+    stream_json = client_config.get('stream_json', 'true').lower() in ('true', 'yes', '1', 'on')
     
-    url = f"http://{host}:{port}/transmission/rpc"
-    session = requests.Session()
+    # 请求统计信息
+    if fetch_stats is None:
+        fetch_stats = {}
+    fetch_stats.update({'http_calls': 0, 'http_time': 0.0})
+    
+    if connection is None:
+        connection = DownloaderConnection(client_id, client_config)
     
     try:
-        # 获取X-Transmission-Session-Id
-        logger.info(f"尝试连接Transmission: {url} (客户端 {client_id})")
-        response = session.get(url, auth=(username, password))
-        if response.status_code == 409:
-            session_id = response.headers.get('X-Transmission-Session-Id')
-            headers = {'X-Transmission-Session-Id': session_id}
-        else:
-            logger.error(f"获取Transmission会话ID失败: {response.status_code} (客户端 {client_id})")
-            return [], []
-        
-        # 获取所有种子信息
-        payload = {
-            "method": "torrent-get",
-            "arguments": {
-                "fields": ["id", "name", "downloadDir", "files", "hashString", "totalSize", "status", "percentDone"]
-            }
-        }
+        logger.info(f"连接Transmission: {connection.base_url}/transmission/rpc (客户端 {client_id})")
+        
+        # 发送RPC请求，逐个返回arguments中的种子，流式模式下边接收边解析
+        def torrent_get(arguments):
+            response = connection.transmission_rpc({"method": "torrent-get", "arguments": arguments}, fetch_stats, stream=stream_json)
+            with response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"Transmission RPC请求失败: {response.status_code} {response.text}")
+                if stream_json:
+                    torrents = iter_json_array(response, 'torrents')
+                else:
+                    torrents = response.json().get('arguments', {}).get('torrents', [])
+                yield from iter_transmission_torrents(torrents)
         
+        # 第一阶段：只获取判断做种状态所需的字段，使用table格式减小响应体积
         logger.info(f"获取Transmission种子列表 (客户端 {client_id})")
-        response = session.post(url, json=payload, headers=headers, auth=(username, password))
-        if response.status_code != 200:
-            logger.error(f"获取Transmission种子列表失败: {response.text} (客户端 {client_id})")
-            return [], []
-        
-        data = response.json()
-        torrents = data.get('arguments', {}).get('torrents', [])
-        logger.info(f"找到 {len(torrents)} 个Transmission种子 (客户端 {client_id})")
+        all_hashes = set()
+        active_torrents = []
+        for torrent in torrent_get({"fields": ["id", "hashString", "status", "percentDone"], "format": "table"}):
+            all_hashes.add(torrent.get('hashString', ''))
+            # 仅处理完成下载并正在做种的种子（状态6=正在做种，百分比100%=已完成）
+            if torrent.get('percentDone', 0) == 1 and torrent.get('status', 0) == 6:
+                active_torrents.append(torrent)
+        fetch_stats['torrent_hashes'] = all_hashes
+        logger.info(f"找到 {len(all_hashes)} 个Transmission种子 (客户端 {client_id})")
+        logger.info(f"其中 {len(active_torrents)} 个正在做种 (客户端 {client_id})")
         seeding_files = []
-        seeding_torrents = []
+        client_info = ClientInfo('Transmission', client_id, f"{host}:{port}", path_mappings_str)
         
-        # 仅处理完成下载并正在做种的种子（状态6=正在做种，百分比100%=已完成）
-        active_torrents = [t for t in torrents if t.get('percentDone', 0) == 1 and t.get('status', 0) == 6]
-        logger.info(f"其中 {len(active_torrents)} 个正在做种 (客户端 {client_id})")
+        # 已缓存文件列表的种子无需再获取文件
+        if file_cache is not None:
+            known_files = file_cache.get_many([t.get('hashString', '') for t in active_torrents])
+        else:
+            known_files = {}
+        uncached_count = sum(1 for t in active_torrents if t.get('hashString', '') not in known_files)
+        logger.info(f"需要获取文件列表的种子: {uncached_count} 个，已缓存: {len(active_torrents) - uncached_count} 个，"
+                    f"分批大小: {batch_size} (客户端 {client_id})")
+        
+        # 第二阶段：按批次只获取做种种子的详细信息和文件列表，内存占用只与单批种子数量相关
+        def iter_active_torrents():
+            detail_fields = ["id", "name", "downloadDir", "hashString", "totalSize"]
+            for i in range(0, len(active_torrents), batch_size):
+                check_fetch_cancelled(cancel_event, client_id)
+                batch = active_torrents[i:i + batch_size]
+                cached_ids = [t['id'] for t in batch if t.get('hashString', '') in known_files]
+                uncached_ids = [t['id'] for t in batch if t.get('hashString', '') not in known_files]
+                
+                details = {}
+                if cached_ids:
+                    for torrent in torrent_get({"ids": cached_ids, "fields": detail_fields, "format": "table"}):
+                        torrent_hash = torrent.get('hashString', '')
+                        torrent['files'] = known_files.get(torrent_hash, [])
+                        details[torrent['id']] = torrent
+                if uncached_ids:
+                    for torrent in torrent_get({"ids": uncached_ids, "fields": detail_fields + ["files"], "format": "table"}):
+                        files = [[file.get('name', ''), file.get('length', 0)] for file in torrent.get('files', [])]
+                        torrent['files'] = files
+                        check_fetch_cancelled(cancel_event, client_id)
+                        if file_cache is not None:
+                            file_cache.put(torrent.get('hashString', ''), files)
+                        details[torrent['id']] = torrent
+                
+                # 按第一阶段的顺序返回，保证去重顺序稳定
+                for torrent in batch:
+                    if torrent['id'] in details:
+                        yield details[torrent['id']]
         
         # 用于去重的集合
         unique_paths = set()
         
-        for torrent in active_torrents:
+        for torrent in iter_active_torrents():
             download_dir = torrent.get('downloadDir', '')
+            torrent_info = TorrentInfo(client_info, torrent.get('name', ''), torrent.get('hashString', ''),
+                                       '做种中', download_dir)
             files = torrent.get('files', [])
-            torrent_name = torrent.get('name', '')
-            torrent_hash = torrent.get('hashString', '')
-            torrent_size = torrent.get('totalSize', 0)
             
-            for file in files:
-                file_name = file.get('name', '')
+            for file_name, file_size in files:
                 file_path = os.path.normpath(os.path.join(download_dir, file_name))
-                file_size = file.get('length', 0)
                 
                 # 保存原始路径用于参考
                 original_path = file_path
                 
-                # 应用路径映射
-                mapped_file_path = apply_path_mapping(file_path, path_mappings_str)
-                
-                # 确保路径规范化
-                mapped_file_path = os.path.normpath(mapped_file_path)
+                # 应用路径映射，结果已经是规范化路径
+                mapped_file_path = path_mapper.map(file_path)
                 
                 # 记录映射前后的路径，便于调试
                 if mapped_file_path != file_path:
-                    logger.info(f"文件路径映射: {file_path} -> {mapped_file_path} (客户端 {client_id})")
+                    logger.debug(f"文件路径映射: {file_path} -> {mapped_file_path} (客户端 {client_id})")
                 
                 # 去重检查
                 if mapped_file_path not in unique_paths:
                     unique_paths.add(mapped_file_path)
-                    seeding_files.append(mapped_file_path)
-                    
-                    # 收集种子信息
-                    seeding_torrents.append({
-                        'file_path': mapped_file_path,
-                        'original_path': original_path,  # 保存原始路径，用于调试
-                        'file_name': os.path.basename(mapped_file_path),
-                        'file_size': file_size,
-                        'file_size_human': humanize.naturalsize(file_size, binary=True) if file_size else "未知",
-                        'torrent_name': torrent_name,
-                        'torrent_hash': torrent_hash,
-                        'torrent_state': '做种中',
-                        'save_path': download_dir,
-                        'client_type': 'Transmission',
-                        'client_id': client_id,
-                        'client_host': f"{host}:{port}",
-                        'path_mapping': path_mappings_str  # 添加路径映射配置，便于排查
-                    })
+                    # 保存原始路径用于调试，种子和下载器信息按引用共享
+                    seeding_files.append(SeedingFile(mapped_file_path, original_path, file_size, torrent_info))
         
+        fetch_stats['success'] = True
         logger.info(f"Transmission做种文件总数: {len(seeding_files)} (客户端 {client_id})")
-        return seeding_files, seeding_torrents
+        return seeding_files
     
     except Exception as e:
+        if cancel_event is not None and cancel_event.is_set():
+            logger.warning(f"已超过截止时间，停止获取Transmission做种文件 (客户端 {client_id})")
+            return []
         logger.error(f"获取Transmission做种文件时出错: {str(e)} (客户端 {client_id})")
         import traceback
         logger.error(traceback.format_exc())
-        return [], []
+        return []
 
 # 获取qBittorrent做种文件 (旧版兼容)
 def get_qbittorrent_files(config):
     if 'qbittorrent' not in config:
         logger.error("配置文件中缺少 'qbittorrent' 部分")
-        return [], []
+        return []
     
     return get_qbittorrent_files_from_config(config['qbittorrent'])
 
@@ -529,250 +1313,1155 @@ def get_qbittorrent_files(config):
 def get_transmission_files(config):
     if 'transmission' not in config:
         logger.error("配置文件中缺少 'transmission' 部分")
-        return [], []
+        return []
     
     return get_transmission_files_from_config(config['transmission'])
 
-# 获取文件详细信息
-def get_file_details(file_path):
+# NAS文件记录：每个满足大小阈值的文件一条，使用 __slots__ 避免每个文件一个字典
+# 大小为整数字节数，时间为整数秒的时间戳，扩展名经 sys.intern 在所有记录间共享；
+# 大小和时间的可读格式只在写报告时才计算，数百万文件的清单中绝大多数记录永远不会被格式化
+# device/inode 用于识别同一文件的多个硬链接，nlink 为硬链接数；无法获取信息时 ctime/mtime 为 None
+class NasFileRecord:
+    __slots__ = ('size_bytes', 'ctime', 'mtime', 'extension', 'file_type', 'device', 'inode', 'nlink')
+    
+    def __init__(self, size_bytes, ctime, mtime, extension, file_type, device=None, inode=None, nlink=1):
+        self.size_bytes = size_bytes
+        self.ctime = ctime
+        self.mtime = mtime
+        self.extension = extension
+        self.file_type = file_type
+        self.device = device
+        self.inode = inode
+        self.nlink = nlink
+    
+    @property
+    def size_human(self):
+        # 无法获取信息的文件大小记为 0，报告中显示为未知
+        if self.ctime is None:
+            return "未知"
+        return humanize.naturalsize(self.size_bytes, binary=True)
+    
+    @property
+    def create_time(self):
+        return format_timestamp(self.ctime)
+    
+    @property
+    def modify_time(self):
+        return format_timestamp(self.mtime)
+    
+    # 增量扫描索引中以列表形式保存，比键值对形式的JSON更紧凑
+    def to_list(self):
+        return [self.size_bytes, self.ctime, self.mtime, self.extension, self.file_type,
+                self.device, self.inode, self.nlink]
+    
+    @classmethod
+    def from_list(cls, values):
+        size_bytes, ctime, mtime, extension, file_type, device, inode, nlink = values
+        return cls(size_bytes, ctime, mtime, sys.intern(extension), FILE_TYPE_NAMES.get(file_type, file_type),
+                   device, inode, nlink)
+
+# 按扩展名分类文件类型
+FILE_TYPES = {'.m2ts': "蓝光原盘"}
+FILE_TYPES.update(dict.fromkeys(('.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm'), "视频"))
+FILE_TYPES.update(dict.fromkeys(('.mp3', '.wav', '.flac', '.aac', '.ogg', '.m4a'), "音频"))
+FILE_TYPES.update(dict.fromkeys(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff'), "图片"))
+FILE_TYPES.update(dict.fromkeys(('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.txt'), "文档"))
+# 从索引读回的类型名称映射回同一个字符串对象
+FILE_TYPE_NAMES = {name: name for name in list(FILE_TYPES.values()) + ["未知"]}
+
+# 将时间戳格式化为报告中使用的本地时间字符串
+def format_timestamp(timestamp):
+    if timestamp is None:
+        return "未知"
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+# 获取文件详细信息，返回 NasFileRecord；file_stat 为扫描时已取得的 stat 结果，传入时不再重复调用 os.stat
+def get_file_details(file_path, file_stat=None):
     try:
-        file_stat = os.stat(file_path)
-        size_bytes = file_stat.st_size
-        size_human = humanize.naturalsize(size_bytes, binary=True)
-        
-        # 获取创建和修改时间
-        ctime = datetime.fromtimestamp(file_stat.st_ctime)
-        mtime = datetime.fromtimestamp(file_stat.st_mtime)
-        
-        # 计算文件类型
-        file_type = "未知"
+        if file_stat is None:
+            file_stat = os.stat(file_path)
         ext = os.path.splitext(file_path)[1].lower()
-        if ext == '.m2ts':
-            file_type = "蓝光原盘"
-        elif ext in ('.mp4', '.mkv', '.avi', '.mov', '.wmv', '.flv', '.webm'):
-            file_type = "视频"
-        elif ext in ('.mp3', '.wav', '.flac', '.aac', '.ogg', '.m4a'):
-            file_type = "音频"
-        elif ext in ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff'):
-            file_type = "图片"
-        elif ext in ('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.txt'):
-            file_type = "文档"
-        
-        # 返回详细信息字典
-        return {
-            'size_bytes': size_bytes,
-            'size_human': size_human,
-            'create_time': ctime.strftime('%Y-%m-%d %H:%M:%S'),
-            'modify_time': mtime.strftime('%Y-%m-%d %H:%M:%S'),
-            'file_type': file_type,
-            'extension': ext[1:] if ext else ""
-        }
+        return NasFileRecord(
+            file_stat.st_size,
+            int(file_stat.st_ctime),
+            int(file_stat.st_mtime),
+            sys.intern(ext[1:]),
+            FILE_TYPES.get(ext, "未知"),
+            file_stat.st_dev,
+            file_stat.st_ino,
+            file_stat.st_nlink
+        )
     except Exception as e:
         logger.warning(f"无法获取文件详细信息: {file_path}, 错误: {str(e)}")
-        return {
-            'size_bytes': 0,
-            'size_human': "未知",
-            'create_time': "未知",
-            'modify_time': "未知",
-            'file_type': "未知",
-            'extension': "未知"
-        }
+        return NasFileRecord(0, None, None, "未知", "未知")
 
-# 获取指定目录下的所有文件
-def get_nas_files(directory, size_threshold, exclude_dirs=None, ignore_links=True):
+# 排除目录匹配器：预先编译 exclude_directories 配置，扫描时整棵子树直接剪枝，不再打开被排除的目录
+# 不含通配符的规则按完整路径精确匹配，含 * 或 ? 的规则按通配符匹配完整路径，* 可跨越多级目录，
+# 例如 */@eaDir、*/#recycle 可排除任意位置的NAS元数据目录；[ ] 按普通字符处理，避免与种子目录名冲突
+class ExcludeMatcher:
+    def __init__(self, exclude_dirs):
+        self.exact_dirs = set()
+        self.patterns = []
+        for exclude_dir in exclude_dirs or []:
+            exclude_dir = os.path.normpath(exclude_dir.strip())
+            if '*' in exclude_dir or '?' in exclude_dir:
+                self.patterns.append(exclude_dir)
+            else:
+                self.exact_dirs.add(exclude_dir)
+        
+        self.pattern_regex = None
+        if self.patterns:
+            # 每条规则一个捕获分组，命中时通过 lastindex 找回对应的规则用于日志
+            translated = ['(' + re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.') + ')'
+                          for pattern in self.patterns]
+            self.pattern_regex = re.compile('(?s:' + '|'.join(translated) + r')\Z')
+    
+    def __bool__(self):
+        return bool(self.exact_dirs or self.patterns)
+    
+    # 判断一个已规范化的目录本身是否命中排除规则，返回命中的规则，未命中时返回 None
+    def match(self, norm_path):
+        if norm_path in self.exact_dirs:
+            return norm_path
+        if self.pattern_regex is not None:
+            match = self.pattern_regex.match(norm_path)
+            if match:
+                return self.patterns[match.lastindex - 1]
+        return None
+    
+    # 判断目录本身或其任一上级目录是否被排除，只用于扫描起点，遍历中的子目录在入栈前已逐级检查
+    def covers(self, norm_path):
+        path = norm_path
+        while True:
+            rule = self.match(path)
+            if rule:
+                return rule
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+# NAS增量扫描索引：按目录保存 mtime 和 scan_nas_directory 的扫描结果，gzip压缩的JSON保存在状态目录中
+# 目录中增删或重命名条目会改变目录的 mtime，mtime 未变化的目录复用上次的结果，跳过列目录和小于阈值的文件的 stat
+# 其他目录中增删硬链接和文件原地修改不会改变目录的 mtime，复用前会重新 stat 索引中的文件确认硬链接数、大小和修改时间；
+# 小于阈值的文件原地增大到阈值以上无法发现，因此每隔 full_rescan_days 天强制完整扫描一次
+class NasScanIndex:
+    VERSION = 4
+    # 距扫描开始过近的 mtime 可能在本次列出目录之后仍被修改(文件系统时间精度有限)，这类目录不写入索引
+    RACY_MTIME_NS = 2 * 1000 * 1000 * 1000
+    
+    def __init__(self, index_file, settings, full_rescan=False, full_rescan_days=7):
+        self.index_file = index_file
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.previous = {}
+        self.current = {}
+        self.full_scan_time = time.time()
+        self.scan_start_ns = time.time_ns()
+        self.reused_dirs = 0
+        self.scanned_dirs = 0
+        
+        if full_rescan:
+            logger.info("已指定完整扫描，本次忽略NAS扫描索引")
+            return
+        
+        data = self.load()
+        if not data:
+            return
+        if data.get('version') != self.VERSION or data.get('settings') != settings:
+            logger.info("扫描相关配置已变化，忽略旧的NAS扫描索引")
+            return
+        full_scan_time = data.get('full_scan_time', 0)
+        if full_rescan_days > 0 and time.time() - full_scan_time >= full_rescan_days * 86400:
+            logger.info(f"距上次完整扫描已超过 {full_rescan_days} 天，本次完整扫描NAS目录")
+            return
+        self.previous = data.get('dirs', {})
+        self.full_scan_time = full_scan_time
+        logger.info(f"加载NAS扫描索引: {index_file}, 目录数: {len(self.previous)}")
+    
+    def load(self):
+        if not os.path.exists(self.index_file):
+            return None
+        try:
+            with gzip.open(self.index_file, 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"读取NAS扫描索引出错: {self.index_file}, 错误: {str(e)}")
+            return None
+    
+    # 查找 mtime 未变化的目录，命中时返回上次的扫描结果，并保留到新的索引中
+    def lookup(self, root, mtime_ns):
+        if mtime_ns is None:
+            return None
+        entry = self.previous.get(root)
+        if entry is None or entry['mtime_ns'] != mtime_ns:
+            return None
+        scan = dict(entry['scan'])
+        files = self.restat_files(scan['files'], scan['links'])
+        if files is None:
+            return None
+        with self.lock:
+            self.current[root] = entry
+            self.reused_dirs += 1
+        scan['files'] = files
+        # 复用的目录本次 stat 了目录本身和索引中的文件
+        scan['counters'] = dict(scan['counters'], stat=1 + len(scan['files']) + len(scan['links']))
+        return scan
+    
+    # 重新 stat 索引中的文件，硬链接数、大小或修改时间与索引不一致时返回 None，整个目录重新扫描；
+    # 因硬链接跳过的文件只剩一个链接时同样重新扫描，软链接在目录 mtime 不变时不会变化
+    def restat_files(self, cached_files, links):
+        files = []
+        for file_path, values in cached_files:
+            record = NasFileRecord.from_list(values)
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                return None
+            if (file_stat.st_nlink != record.nlink or file_stat.st_size != record.size_bytes or
+                    int(file_stat.st_mtime) != record.mtime):
+                return None
+            files.append((file_path, record))
+        for file_path in links:
+            try:
+                file_stat = os.lstat(file_path)
+            except OSError:
+                return None
+            if not stat.S_ISLNK(file_stat.st_mode) and file_stat.st_nlink <= 1:
+                return None
+        return files
+    
+    def store(self, root, mtime_ns, scan):
+        with self.lock:
+            self.scanned_dirs += 1
+            if self.scan_start_ns - mtime_ns < self.RACY_MTIME_NS:
+                return
+            entry_scan = dict(scan)
+            entry_scan['files'] = [(file_path, record.to_list()) for file_path, record in scan['files']]
+            self.current[root] = {'mtime_ns': mtime_ns, 'scan': entry_scan}
+    
+    def save(self):
+        logger.info(f"NAS增量扫描: 复用 {self.reused_dirs} 个未变化的目录, 重新扫描 {self.scanned_dirs} 个目录")
+        try:
+            save_json_atomic(self.index_file, {
+                'version': self.VERSION,
+                'settings': self.settings,
+                'full_scan_time': self.full_scan_time,
+                'dirs': self.current,
+            })
+        except Exception as e:
+            logger.warning(f"保存NAS扫描索引出错: {self.index_file}, 错误: {str(e)}")
+
+# 单个目录的扫描结果
+#   listed: 目录是否成功列出
+#   files: 满足大小阈值的文件 [(file_path, NasFileRecord)]
+#   subdirs: 需要继续遍历的子目录
+#   links: 因 ignore_links 跳过的软链接文件，以及未启用 inode 匹配时跳过的硬链接文件
+#   pruned: 命中排除规则、被剪枝的子目录
+#   errors: 无法获取信息的文件
+#   counters: 软链接、硬链接、错误和排除目录的数量，以及 stat 调用次数
+def new_directory_scan():
+    return {
+        'listed': True,
+        'files': [],
+        'subdirs': [],
+        'links': [],
+        'pruned': [],
+        'errors': [],
+        'counters': {'symlink': 0, 'hardlink': 0, 'error': 0, 'excluded': 0, 'stat': 0},
+    }
+
+# 扫描单个目录，返回 new_directory_scan 格式的扫描结果
+# 借助 os.scandir 的 DirEntry 类型信息判断目录和软链接，每个文件只调用一次 lstat/stat，
+# 同一个 stat 结果同时用于硬链接判断、文件大小和 get_file_details；命中排除规则的子目录不会继续遍历
+# ignore_hardlinks 默认与 ignore_links 相同；启用 inode 匹配时硬链接文件照常记录，由对比阶段按 inode 识别
+def scan_nas_directory(root, size_threshold_bytes, ignore_links, exclude_matcher=None, scan_index=None,
+                       ignore_hardlinks=None):
+    if ignore_hardlinks is None:
+        ignore_hardlinks = ignore_links
+    
+    # 增量扫描：目录的 mtime 没有变化时直接使用索引中的结果，不再列出目录和逐个 stat 文件
+    dir_mtime_ns = None
+    if scan_index is not None:
+        try:
+            dir_mtime_ns = os.stat(root).st_mtime_ns
+        except OSError:
+            dir_mtime_ns = None
+        cached = scan_index.lookup(root, dir_mtime_ns)
+        if cached is not None:
+            return cached
+    
+    scan = new_directory_scan()
+    counters = scan['counters']
+    if scan_index is not None:
+        counters['stat'] += 1
+    try:
+        # 按名称排序，保证每次扫描结果的顺序一致，便于比较不同时间的报告
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        logger.warning(f"无法读取目录: {root}, 错误: {str(e)}")
+        scan['listed'] = False
+        counters['error'] += 1
+        return scan
+    
+    for entry in entries:
+        file_path = entry.path
+        try:
+            # 与 os.walk(followlinks=True) 相同，指向目录的软链接也会被遍历
+            if entry.is_dir():
+                if exclude_matcher:
+                    rule = exclude_matcher.match(os.path.normpath(file_path))
+                    if rule:
+                        logger.debug(f"排除目录: {file_path} (匹配规则: {rule})")
+                        counters['excluded'] += 1
+                        scan['pruned'].append(file_path)
+                        continue
+                if entry.is_symlink():
+                    logger.info(f"发现符号链接目录: {file_path} -> {os.path.realpath(file_path)}")
+                scan['subdirs'].append(file_path)
+                continue
+            
+            # 检查是否为符号链接或硬链接
+            if entry.is_symlink():
+                counters['symlink'] += 1
+                logger.debug(f"跳过软链接文件: {file_path} -> {os.path.realpath(file_path)}")
+                # 如果配置为忽略链接，则跳过
+                if ignore_links:
+                    scan['links'].append(file_path)
+                    continue
+                # 不忽略链接时按链接目标统计大小和时间
+                counters['stat'] += 1
+                stat_info = entry.stat()
+            else:
+                counters['stat'] += 1
+                stat_info = entry.stat(follow_symlinks=False)
+                # 检查是否为硬链接(st_nlink > 1)
+                if stat_info.st_nlink > 1:
+                    counters['hardlink'] += 1
+                    logger.debug(f"检测到硬链接文件: {file_path}, 链接数: {stat_info.st_nlink}")
+                    # 如果配置为忽略链接，则跳过
+                    if ignore_hardlinks:
+                        scan['links'].append(file_path)
+                        continue
+            
+            if stat_info.st_size >= size_threshold_bytes:
+                file_details = get_file_details(file_path, stat_info)
+                scan['files'].append((file_path, file_details))
+        except Exception as e:
+            logger.warning(f"无法处理文件: {file_path}, 错误: {str(e)}")
+            counters['error'] += 1
+            scan['errors'].append(file_path)
+    
+    # 出现错误的目录不写入索引，下次扫描时重试
+    if scan_index is not None and dir_mtime_ns is not None and not counters['error']:
+        scan_index.store(root, dir_mtime_ns, scan)
+    
+    return scan
+
+# 汇总一个扫描起点下所有目录的扫描结果，返回 (文件数, 合并后的计数)
+def summarize_directory_scans(dir_scans):
+    file_count = 0
+    totals = {'symlink': 0, 'hardlink': 0, 'error': 0, 'excluded': 0, 'stat': 0}
+    for _, scan in dir_scans:
+        file_count += len(scan['files'])
+        for key, value in scan['counters'].items():
+            totals[key] += value
+    return file_count, totals
+
+# 扫描指定目录下的所有文件，返回按先序遍历排列的 [(目录, 扫描结果)]
+def get_nas_files(directory, size_threshold, exclude_dirs=None, ignore_links=True, scan_index=None,
+                  ignore_hardlinks=None):
     try:
         if not os.path.exists(directory):
             logger.error(f"目录不存在: {directory}")
-            return [], 0, 0, 0
-        
-        # 初始化排除目录列表
-        if exclude_dirs is None:
-            exclude_dirs = []
+            return []
         
-        # 规范化排除目录路径
-        norm_exclude_dirs = [os.path.normpath(d) for d in exclude_dirs]
+        # 预先编译排除规则，被排除的子树在遍历时直接剪枝
+        if isinstance(exclude_dirs, ExcludeMatcher):
+            exclude_matcher = exclude_dirs
+        else:
+            exclude_matcher = ExcludeMatcher(exclude_dirs)
         
-        nas_files = []
         size_threshold_bytes = size_threshold * 1024 * 1024  # 转换为字节
         logger.info(f"开始扫描NAS目录: {directory}，大小阈值: {size_threshold}MB，忽略链接: {ignore_links}")
-        logger.info(f"排除目录: {norm_exclude_dirs}")
-        
-        # 记录符号链接相关信息
-        symlink_count = 0
-        hardlink_count = 0
-        normal_file_count = 0
-        error_count = 0
-        excluded_count = 0
-        
-        for root, _, files in os.walk(directory, followlinks=True):
-            # 检查是否为符号链接目录
-            is_symlink_dir = os.path.islink(root)
-            if is_symlink_dir:
-                logger.info(f"发现符号链接目录: {root} -> {os.path.realpath(root)}")
-            
-            # 检查当前目录是否应该被排除
-            norm_root = os.path.normpath(root)
-            should_exclude = False
-            for exclude_dir in norm_exclude_dirs:
-                if norm_root == exclude_dir or norm_root.startswith(exclude_dir + os.sep):
-                    logger.debug(f"排除目录: {norm_root} (匹配规则: {exclude_dir})")
-                    should_exclude = True
-                    excluded_count += len(files)
-                    break
-            
-            if should_exclude:
-                continue
-            
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    # 检查是否为符号链接或硬链接
-                    if os.path.islink(file_path):
-                        symlink_count += 1
-                        logger.debug(f"跳过软链接文件: {file_path} -> {os.path.realpath(file_path)}")
-                        # 如果配置为忽略链接，则跳过
-                        if ignore_links:
-                            continue
-                    else:
-                        # 检查是否为硬链接(st_nlink > 1)
-                        stat_info = os.stat(file_path)
-                        if stat_info.st_nlink > 1:
-                            hardlink_count += 1
-                            logger.debug(f"检测到硬链接文件: {file_path}, 链接数: {stat_info.st_nlink}")
-                            # 如果配置为忽略链接，则跳过
-                            if ignore_links:
-                                continue
-                    
-                    # 获取文件大小
-                    file_size = os.path.getsize(file_path)
-                    if file_size >= size_threshold_bytes:
-                        file_details = get_file_details(file_path)
-                        nas_files.append((file_path, file_details))
-                        normal_file_count += 1
-                except Exception as e:
-                    logger.warning(f"无法处理文件: {file_path}, 错误: {str(e)}")
-                    error_count += 1
+        logger.info(f"排除目录: {sorted(exclude_matcher.exact_dirs)}, 排除规则: {exclude_matcher.patterns}")
+        
+        # 扫描起点本身位于被排除的目录中时整个跳过
+        rule = exclude_matcher.covers(os.path.normpath(directory))
+        if rule:
+            logger.info(f"扫描目录位于排除目录中，跳过: {directory} (匹配规则: {rule})")
+            return []
+        
+        # 用栈代替 os.walk 做先序遍历
+        dir_scans = []
+        pending_dirs = [directory]
+        while pending_dirs:
+            root = pending_dirs.pop()
+            scan = scan_nas_directory(root, size_threshold_bytes, ignore_links, exclude_matcher, scan_index,
+                                      ignore_hardlinks)
+            dir_scans.append((root, scan))
+            pending_dirs.extend(reversed(scan['subdirs']))
         
-        logger.info(f"扫描完成: 找到 {len(nas_files)} 个普通文件, {symlink_count} 个软链接, "
-                   f"{hardlink_count} 个硬链接, 排除了 {excluded_count} 个文件, 遇到 {error_count} 个错误")
-        return nas_files, symlink_count, hardlink_count, error_count
+        file_count, counters = summarize_directory_scans(dir_scans)
+        logger.info(f"扫描完成: 找到 {file_count} 个普通文件, {counters['symlink']} 个软链接, "
+                   f"{counters['hardlink']} 个硬链接, 剪枝了 {counters['excluded']} 个排除目录, "
+                   f"遇到 {counters['error']} 个错误")
+        return dir_scans
     
     except Exception as e:
         logger.error(f"扫描NAS文件时出错: {str(e)}")
         import traceback
         logger.error(traceback.format_exc())
-        return [], 0, 0, 0
+        return []
 
-# 获取多个NAS目录下的所有文件
-def get_all_nas_files(config):
-    try:
-        # 获取目录列表
-        size_threshold = int(config['general'].get('size_threshold', 100))
-        ignore_links = config['general'].get('ignore_links', 'true').lower() in ('true', 'yes', '1', 'on')
-        
-        # 获取排除目录
-        exclude_dirs_str = config['general'].get('exclude_directories', '')
-        if exclude_dirs_str:
-            # 支持中英文逗号分隔
-            exclude_dirs_str = exclude_dirs_str.replace('，', ',')
-            if ',' in exclude_dirs_str:
-                exclude_dirs = [d.strip() for d in exclude_dirs_str.split(',') if d.strip()]
-            else:
-                exclude_dirs = [exclude_dirs_str.strip()]
-            logger.info(f"配置了以下排除目录: {exclude_dirs}")
-        else:
-            exclude_dirs = []
-            logger.info("未配置排除目录")
-        
-        # 检查是否使用旧的配置格式还是新的格式
-        if 'nas_directory' in config['general']:
-            # 兼容旧格式
-            directory_str = config['general']['nas_directory']
-            logger.info(f"使用旧配置项 'nas_directory': {directory_str}")
-        elif 'nas_directories' in config['general']:
-            # 新格式
-            directory_str = config['general']['nas_directories']
-            logger.info(f"使用配置项 'nas_directories': {directory_str}")
-        else:
-            logger.error("配置文件中缺少 'nas_directories' 或 'nas_directory' 配置")
-            return []
+# 并行扫描多个NAS目录：所有目录和子目录作为独立任务提交到同一个线程池的工作队列，
+# 网络挂载下耗时主要在元数据往返延迟，多个目录同时列出可以充分利用带宽
+# 每个目录的扫描结果自带计数，结果按目录在树中的位置排序，与单线程扫描顺序完全一致
+# 返回值与逐个调用 get_nas_files 相同：每个扫描起点一个 [(目录, 扫描结果)]
+# scan_stats 不为空时记录每个扫描起点从开始扫描到最后一个子目录完成的耗时 {目录: 秒}
+def scan_nas_directories_parallel(directories, size_threshold, exclude_matcher, ignore_links, scan_workers,
+                                  scan_index=None, ignore_hardlinks=None, scan_stats=None):
+    size_threshold_bytes = size_threshold * 1024 * 1024  # 转换为字节
+    start_time = time.time()
+    # 每个扫描起点的结果：位置键 -> (目录, 扫描结果)
+    results = [{} for _ in directories]
+    pending = {}
+    
+    with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+        # 位置键为从扫描起点到该目录的子目录序号元组，按元组排序即为先序遍历顺序
+        def submit(root_index, order_key, path):
+            future = executor.submit(scan_nas_directory, path, size_threshold_bytes, ignore_links,
+                                     exclude_matcher, scan_index, ignore_hardlinks)
+            pending[future] = (root_index, order_key, path)
         
-        # 解析目录列表，支持中英文逗号分隔的多个目录
-        directory_str = directory_str.replace('，', ',')
-        if ',' in directory_str:
-            directories = [d.strip() for d in directory_str.split(',') if d.strip()]
-        else:
-            directories = [directory_str.strip()]
+        for root_index, directory in enumerate(directories):
+            if not os.path.exists(directory):
+                logger.error(f"目录不存在: {directory}")
+                continue
+            rule = exclude_matcher.covers(os.path.normpath(directory))
+            if rule:
+                logger.info(f"扫描目录位于排除目录中，跳过: {directory} (匹配规则: {rule})")
+                continue
+            logger.info(f"开始扫描NAS目录: {directory}，大小阈值: {size_threshold}MB，忽略链接: {ignore_links}")
+            submit(root_index, (), directory)
+        
+        while pending:
+            done, _ = wait_futures(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                root_index, order_key, path = pending.pop(future)
+                try:
+                    scan = future.result()
+                except Exception as e:
+                    logger.warning(f"无法读取目录: {path}, 错误: {str(e)}")
+                    scan = new_directory_scan()
+                    scan['listed'] = False
+                    scan['counters']['error'] += 1
+                
+                results[root_index][order_key] = (path, scan)
+                if scan_stats is not None:
+                    scan_stats[directories[root_index]] = time.time() - start_time
+                for i, subdir in enumerate(scan['subdirs']):
+                    submit(root_index, order_key + (i,), subdir)
+    
+    scan_results = []
+    for directory, listings in zip(directories, results):
+        dir_scans = [listings[order_key] for order_key in sorted(listings)]
+        file_count, counters = summarize_directory_scans(dir_scans)
+        logger.info(f"扫描完成: {directory} 找到 {file_count} 个普通文件, {counters['symlink']} 个软链接, "
+                    f"{counters['hardlink']} 个硬链接, 剪枝了 {counters['excluded']} 个排除目录, "
+                    f"遇到 {counters['error']} 个错误")
+        scan_results.append(dir_scans)
+    
+    logger.info(f"并行扫描 {len(directories)} 个NAS目录完成，耗时 {time.time() - start_time:.1f} 秒")
+    return scan_results
+
+# Linux inotify 的最小封装，通过 ctypes 直接调用 libc，不依赖第三方库
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    # 目录内容或其中文件大小的任何变化都会触发该目录的重新扫描
+    DIRECTORY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                      IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct('iIII')
+    
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    
+    # 添加监视，失败时抛出带 errno 的 OSError，监视数量达到上限时 errno 为 ENOSPC
+    def add_watch(self, path, mask=DIRECTORY_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+    
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+    
+    # 读取当前所有待处理的事件，返回 (wd, mask, name) 列表，没有事件时返回空列表
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, name))
+    
+    def close(self):
+        os.close(self.fd)
+
+# NAS目录监视器：启动时完整扫描一次，之后根据 inotify 事件维护内存中的文件清单，检查时无需再遍历磁盘
+# 清单按目录保存 scan_nas_directory 的结果；某个目录收到事件后只重新扫描这一个目录，
+# 新出现的子目录先添加监视再扫描，消失的子目录连同其监视一起移除
+# 事件队列溢出时所有目录在下次刷新时重新扫描；监视数量达到上限时，无法监视的目录只在每次检查获取清单时重新扫描，
+# 不随后台刷新反复遍历，保证检查时清单与磁盘一致
+class NasWatcher:
+    def __init__(self, settings, refresh_interval=60):
+        self.settings = settings
+        self.directories = settings['directories']
+        self.size_threshold_bytes = settings['size_threshold'] * 1024 * 1024
+        self.ignore_links = settings['ignore_links']
+        self.ignore_hardlinks = settings['ignore_hardlinks']
+        self.exclude_matcher = settings['exclude_matcher']
+        self.refresh_interval = refresh_interval
+        self.inotify = Inotify()
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        # 目录 -> scan_nas_directory 的扫描结果
+        self.dirs = {}
+        # 同一个目录可能通过软链接以多个路径出现，移动后新旧路径也可能短暂共用一个 wd
+        self.wd_paths = {}
+        self.path_wd = {}
+        # 收到事件、等待重新扫描的目录，以及无法添加监视、每次检查时都要重新扫描的目录
+        self.dirty_dirs = set()
+        self.unwatched_dirs = set()
+        self.watch_limit_reached = False
+        self.roots = set()
         
-        logger.info(f"需要扫描的目录列表: {directories}")
-        logger.info(f"是否忽略链接文件: {ignore_links}")
+        start_time = time.time()
+        with self.lock:
+            for directory in self.directories:
+                rule = self.exclude_matcher.covers(os.path.normpath(directory))
+                if rule:
+                    logger.info(f"扫描目录位于排除目录中，跳过: {directory} (匹配规则: {rule})")
+                    continue
+                self.roots.add(directory)
+                if not os.path.isdir(directory):
+                    logger.error(f"目录不存在: {directory}")
+                    self.unwatched_dirs.add(directory)
+                    continue
+                self.add_subtree(directory)
+        logger.info(f"NAS目录监视已建立: 监视 {len(self.path_wd)} 个目录, 耗时 {time.time() - start_time:.1f} 秒")
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='nas-watcher', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.inotify.close()
+    
+    # 后台线程持续读取事件，避免内核事件队列溢出，并定期刷新收到事件的目录
+    def run(self):
+        last_refresh = time.time()
+        while not self.stop_event.is_set():
+            try:
+                readable, _, _ = select.select([self.inotify.fd], [], [], 1.0)
+                if readable:
+                    self.process_events()
+                if time.time() - last_refresh >= self.refresh_interval:
+                    with self.lock:
+                        self.refresh()
+                    last_refresh = time.time()
+            except Exception as e:
+                logger.error(f"处理NAS目录监视事件时出错: {str(e)}")
+                import traceback
+                logger.error(traceback.format_exc())
+                time.sleep(1)
+    
+    def process_events(self):
+        with self.lock:
+            events = self.inotify.read_events()
+            for wd, mask, name in events:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    # 事件已丢失，无法确定哪些目录发生了变化，全部重新扫描
+                    logger.warning("inotify 事件队列溢出，将重新扫描所有NAS目录")
+                    self.dirty_dirs.update(self.dirs)
+                    self.dirty_dirs.update(self.roots)
+                    continue
+                paths = self.wd_paths.get(wd)
+                if not paths:
+                    continue
+                if mask & Inotify.IN_IGNORED:
+                    # 监视已被内核移除(目录被删除或卸载)，刷新时重新扫描，仍存在的目录会重新添加监视
+                    for path in paths:
+                        self.path_wd.pop(path, None)
+                        self.dirty_dirs.add(path)
+                    del self.wd_paths[wd]
+                    continue
+                self.dirty_dirs.update(paths)
+    
+    # 为目录添加监视，监视数量达到上限时记录下来，之后每次检查时重新扫描该目录
+    def watch_directory(self, path):
+        if path in self.path_wd:
+            return
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC and not self.watch_limit_reached:
+                self.watch_limit_reached = True
+                logger.warning("inotify 监视数量已达上限(fs.inotify.max_user_watches)，"
+                               "无法监视的目录将在每次检查时重新扫描")
+            elif e.errno != errno.ENOSPC:
+                logger.warning(f"无法监视目录: {path}, 错误: {str(e)}")
+            self.unwatched_dirs.add(path)
+            return
+        self.unwatched_dirs.discard(path)
+        self.path_wd[path] = wd
+        self.wd_paths.setdefault(wd, set()).add(path)
+    
+    def unwatch_directory(self, path):
+        self.unwatched_dirs.discard(path)
+        wd = self.path_wd.pop(path, None)
+        if wd is None:
+            return
+        paths = self.wd_paths.get(wd)
+        if paths is None:
+            return
+        paths.discard(path)
+        if not paths:
+            del self.wd_paths[wd]
+            self.inotify.rm_watch(wd)
+    
+    # 先添加监视再扫描，扫描期间发生的变化会产生事件，不会遗漏
+    def add_subtree(self, directory):
+        pending_dirs = [directory]
+        while pending_dirs:
+            root = pending_dirs.pop()
+            self.watch_directory(root)
+            scan = scan_nas_directory(root, self.size_threshold_bytes, self.ignore_links, self.exclude_matcher,
+                                      ignore_hardlinks=self.ignore_hardlinks)
+            self.dirs[root] = scan
+            pending_dirs.extend(subdir for subdir in reversed(scan['subdirs']) if subdir not in self.dirs)
+    
+    def remove_subtree(self, directory):
+        pending_dirs = [directory]
+        while pending_dirs:
+            root = pending_dirs.pop()
+            self.unwatch_directory(root)
+            self.dirty_dirs.discard(root)
+            scan = self.dirs.pop(root, None)
+            if scan is not None:
+                pending_dirs.extend(scan['subdirs'])
+    
+    # 重新扫描单个目录，并根据子目录的变化添加或移除整棵子树
+    def refresh_directory(self, path):
+        if not os.path.isdir(path):
+            self.remove_subtree(path)
+            if path in self.roots:
+                self.unwatched_dirs.add(path)
+            return
+        if path not in self.dirs:
+            # 非扫描起点的新目录由其上级目录的刷新负责添加
+            if path in self.roots:
+                self.add_subtree(path)
+            return
         
-        # 扫描所有目录并合并文件列表
-        all_files = []
-        total_symlinks = 0
-        total_hardlinks = 0
-        total_errors = 0
+        self.watch_directory(path)
+        old_subdirs = self.dirs[path]['subdirs']
+        scan = scan_nas_directory(path, self.size_threshold_bytes, self.ignore_links, self.exclude_matcher,
+                                  ignore_hardlinks=self.ignore_hardlinks)
+        self.dirs[path] = scan
         
-        for directory in directories:
-            if directory:  # 确保目录不为空
-                files, symlinks, hardlinks, errors = get_nas_files(directory, size_threshold, exclude_dirs, ignore_links)
-                logger.info(f"目录 {directory} 中找到 {len(files)} 个文件, {symlinks} 个软链接, {hardlinks} 个硬链接")
-                all_files.extend(files)
-                total_symlinks += symlinks
-                total_hardlinks += hardlinks
-                total_errors += errors
-        
-        # 去重 (基于文件路径)
-        unique_paths = set()
-        unique_files = []
-        for file_path, details in all_files:
-            norm_path = os.path.normpath(file_path)
-            if norm_path not in unique_paths:
-                unique_paths.add(norm_path)
-                unique_files.append((file_path, details))
+        new_subdirs = set(scan['subdirs'])
+        for subdir in old_subdirs:
+            if subdir not in new_subdirs:
+                self.remove_subtree(subdir)
+        for subdir in scan['subdirs']:
+            if subdir not in self.dirs:
+                self.add_subtree(subdir)
+    
+    # 刷新所有收到事件的目录，include_unwatched 为真时同时重新扫描无法监视的目录
+    def refresh(self, include_unwatched=False):
+        pending = self.dirty_dirs | self.unwatched_dirs if include_unwatched else self.dirty_dirs
+        self.dirty_dirs = set()
+        if not pending:
+            return
+        start_time = time.time()
+        # 按路径排序，上级目录先于子目录刷新，子目录被移除后不会再单独扫描
+        for path in sorted(pending):
+            self.refresh_directory(path)
+        logger.info(f"NAS目录监视: 刷新了 {len(pending)} 个目录, 耗时 {time.time() - start_time:.2f} 秒")
+    
+    # 处理所有待处理的事件后，按扫描起点返回与 get_nas_files 相同格式的 [(目录, 扫描结果)]，顺序与完整扫描一致
+    def get_scan_results(self):
+        self.process_events()
+        with self.lock:
+            self.refresh(include_unwatched=True)
+            scan_results = []
+            for directory in self.directories:
+                dir_scans = []
+                pending_dirs = [directory] if directory in self.dirs else []
+                while pending_dirs:
+                    root = pending_dirs.pop()
+                    scan = self.dirs[root]
+                    dir_scans.append((root, scan))
+                    pending_dirs.extend(subdir for subdir in reversed(scan['subdirs']) if subdir in self.dirs)
+                scan_results.append(dir_scans)
+            logger.info(f"从NAS目录监视清单获取文件列表: 共 {len(self.dirs)} 个目录, "
+                        f"{len(self.unwatched_dirs)} 个目录未能监视")
+            return scan_results
+
+# 解析NAS扫描相关配置，返回扫描目录、大小阈值、链接设置和排除规则，缺少目录配置时返回 None
+def get_nas_scan_settings(config):
+    size_threshold = int(config['general'].get('size_threshold', 100))
+    ignore_links = config['general'].get('ignore_links', 'true').lower() in ('true', 'yes', '1', 'on')
+    # 启用 inode 匹配时硬链接文件不再被忽略，同一文件的多个硬链接按 inode 统一判断是否做种
+    inode_matching = config['general'].get('inode_matching', 'true').lower() in ('true', 'yes', '1', 'on')
+    if ignore_links and inode_matching and 'ignore_links' in config['general'] and 'inode_matching' not in config['general']:
+        logger.warning("配置了 ignore_links = true，但默认开启的 inode_matching 会按 inode 识别硬链接，硬链接文件不再被跳过；"
+                       "如需继续跳过硬链接，请设置 inode_matching = false，设置 inode_matching = true 可消除此警告")
+    
+    # 获取排除目录
+    exclude_dirs_str = config['general'].get('exclude_directories', '')
+    if exclude_dirs_str:
+        # 支持中英文逗号分隔
+        exclude_dirs_str = exclude_dirs_str.replace('，', ',')
+        if ',' in exclude_dirs_str:
+            exclude_dirs = [d.strip() for d in exclude_dirs_str.split(',') if d.strip()]
+        else:
+            exclude_dirs = [exclude_dirs_str.strip()]
+        logger.info(f"配置了以下排除目录: {exclude_dirs}")
+    else:
+        exclude_dirs = []
+        logger.info("未配置排除目录")
+    
+    # 检查是否使用旧的配置格式还是新的格式
+    if 'nas_directory' in config['general']:
+        # 兼容旧格式
+        directory_str = config['general']['nas_directory']
+        logger.info(f"使用旧配置项 'nas_directory': {directory_str}")
+    elif 'nas_directories' in config['general']:
+        # 新格式
+        directory_str = config['general']['nas_directories']
+        logger.info(f"使用配置项 'nas_directories': {directory_str}")
+    else:
+        logger.error("配置文件中缺少 'nas_directories' 或 'nas_directory' 配置")
+        return None
+    
+    # 解析目录列表，支持中英文逗号分隔的多个目录
+    directory_str = directory_str.replace('，', ',')
+    if ',' in directory_str:
+        directories = [d.strip() for d in directory_str.split(',') if d.strip()]
+    else:
+        directories = [directory_str.strip()]
+    
+    logger.info(f"需要扫描的目录列表: {directories}")
+    logger.info(f"是否忽略链接文件: {ignore_links}, 是否按inode匹配硬链接: {inode_matching}")
+    
+    return {
+        'directories': [directory for directory in directories if directory],  # 确保目录不为空
+        'size_threshold': size_threshold,
+        'ignore_links': ignore_links,
+        'ignore_hardlinks': ignore_links and not inode_matching,
+        'inode_matching': inode_matching,
+        'exclude_dirs': exclude_dirs,
+        'exclude_matcher': ExcludeMatcher(exclude_dirs),
+    }
+
+# NAS文件清单：由一次扫描的所有目录扫描结果构建，冗余文件对比和丢失文件检查共用
+# 除满足阈值的文件外，还记录成功列出的目录、跳过的链接文件、被剪枝的目录和出错的路径，
+# 检查做种文件是否存在时大部分路径可直接在清单中得出结论，无需再访问磁盘
+class NasInventory:
+    def __init__(self, directories, size_threshold_bytes, inode_matching=False):
+        self.directories = [os.path.normpath(directory) for directory in directories]
+        self.size_threshold_bytes = size_threshold_bytes
+        self.inode_matching = inode_matching
+        # 满足大小阈值的文件 [(file_path, details)]，按路径去重并保持扫描顺序
+        self.files = []
+        self.file_paths = set()
+        self.scanned_dirs = set()
+        self.link_paths = set()
+        self.pruned_dirs = set()
+        self.error_paths = set()
+        self.symlink_count = 0
+        self.hardlink_count = 0
+        self.error_count = 0
+        # 每个扫描起点的统计 {目录: {'files', 'dirs', 'symlink', 'hardlink', 'error', 'excluded', 'stat'}}
+        self.directory_stats = {}
+    
+    # 加入一个扫描起点下的所有目录扫描结果
+    def add_directory_scans(self, directory, dir_scans):
+        file_count, counters = summarize_directory_scans(dir_scans)
+        self.directory_stats[directory] = dict(counters, files=file_count, dirs=len(dir_scans))
+        logger.info(f"目录 {directory} 中找到 {file_count} 个文件, {counters['symlink']} 个软链接, "
+                    f"{counters['hardlink']} 个硬链接")
+        self.symlink_count += counters['symlink']
+        self.hardlink_count += counters['hardlink']
+        self.error_count += counters['error']
+        
+        for root, scan in dir_scans:
+            norm_root = os.path.normpath(root)
+            if scan['listed']:
+                self.scanned_dirs.add(norm_root)
+            else:
+                self.error_paths.add(norm_root)
+            # 去重 (基于文件路径)
+            for file_path, details in scan['files']:
+                norm_path = os.path.normpath(file_path)
+                if norm_path not in self.file_paths:
+                    self.file_paths.add(norm_path)
+                    self.files.append((file_path, details))
+            self.link_paths.update(os.path.normpath(path) for path in scan['links'])
+            self.pruned_dirs.update(os.path.normpath(path) for path in scan['pruned'])
+            self.error_paths.update(os.path.normpath(path) for path in scan['errors'])
+    
+    # 根据清单判断一个规范化路径的文件是否存在：返回 True/False，无法从清单确定时返回 None
+    # 清单只包含满足大小阈值的文件，上级目录已列出但清单中没有该文件时，磁盘上仍可能有低于阈值的同名文件
+    # (例如被截断的文件，或qBittorrent中设为不下载的文件)，下载器报告的大小并不可靠，交由调用方检查磁盘
+    def lookup(self, norm_path):
+        if norm_path in self.file_paths or norm_path in self.link_paths:
+            return True
+        if norm_path in self.error_paths:
+            return None
+        
+        parent = os.path.dirname(norm_path)
+        if parent in self.scanned_dirs:
+            return None
         
-        logger.info(f"所有目录共找到 {len(unique_files)} 个不重复文件, 共 {total_symlinks} 个软链接, {total_hardlinks} 个硬链接")
+        # 上级目录没有被列出：向上找到最近一个已列出的目录，中间的目录既未被列出、也未被剪枝或出错时，
+        # 说明它在扫描时已不存在(例如整个种子目录被删除)
+        child = parent
+        ancestor = os.path.dirname(child)
+        while ancestor != child:
+            if child in self.pruned_dirs or child in self.error_paths:
+                return None
+            if ancestor in self.scanned_dirs:
+                return False
+            child = ancestor
+            ancestor = os.path.dirname(child)
+        return None
+
+# 扫描所有NAS目录并构建文件清单
+# full_rescan 为 True 时忽略增量扫描索引，重新扫描所有目录
+# 监视模式下由 nas_watcher 直接提供内存中的扫描结果，不再扫描磁盘
+# 每个扫描起点的文件数和各项计数保存在 inventory.directory_stats 中，扫描耗时同时写入其中的 elapsed
+def build_nas_inventory(config, full_rescan=False, nas_watcher=None):
+    if nas_watcher is not None:
+        settings = nas_watcher.settings
+    else:
+        settings = get_nas_scan_settings(config)
+        if settings is None:
+            return NasInventory([], 0)
+    
+    directories = settings['directories']
+    inventory = NasInventory(directories, settings['size_threshold'] * 1024 * 1024, settings['inode_matching'])
+    try:
+        scan_stats = {}
+        if nas_watcher is not None:
+            scan_results = nas_watcher.get_scan_results()
+        else:
+            scan_results = scan_nas_directories(config, settings, full_rescan, scan_stats)
         
-        return unique_files
+        for directory, dir_scans in zip(directories, scan_results):
+            inventory.add_directory_scans(directory, dir_scans)
+            if directory in scan_stats:
+                inventory.directory_stats[directory]['elapsed'] = scan_stats[directory]
         
+        logger.info(f"所有目录共找到 {len(inventory.files)} 个不重复文件, 共 {inventory.symlink_count} 个软链接, "
+                    f"{inventory.hardlink_count} 个硬链接")
     except Exception as e:
         logger.error(f"扫描多个NAS目录时出错: {str(e)}")
         import traceback
         logger.error(traceback.format_exc())
-        return []
+    
+    return inventory
 
-# 找出没有做种的冗余文件
-def find_redundant_files(nas_files, seeding_files):
-    # 规范化路径以便比较
-    seeding_files_normalized = [os.path.normpath(f) for f in seeding_files]
+# 获取多个NAS目录下的所有文件
+def get_all_nas_files(config, full_rescan=False, nas_watcher=None):
+    return build_nas_inventory(config, full_rescan, nas_watcher).files
+
+# 按配置扫描所有NAS目录，支持增量扫描索引和并行扫描，每个扫描起点返回一个 [(目录, 扫描结果)]
+# scan_stats 不为空时记录每个扫描起点的扫描耗时 {目录: 秒}
+def scan_nas_directories(config, settings, full_rescan=False, scan_stats=None):
+    directories = settings['directories']
+    size_threshold = settings['size_threshold']
+    ignore_links = settings['ignore_links']
+    exclude_matcher = settings['exclude_matcher']
+    
+    # 增量扫描索引，扫描结果依赖的配置变化时索引自动失效
+    scan_index = None
+    incremental_scan = config['general'].get('incremental_scan', 'false').lower() in ('true', 'yes', '1', 'on')
+    if incremental_scan:
+        index_file = os.path.join(get_state_directory(config), 'nas_scan_index.json.gz')
+        index_settings = {
+            'size_threshold': size_threshold,
+            'ignore_links': ignore_links,
+            'ignore_hardlinks': settings['ignore_hardlinks'],
+            'exclude_directories': sorted(settings['exclude_dirs']),
+        }
+        full_rescan_days = float(config['general'].get('full_rescan_days', 7))
+        scan_index = NasScanIndex(index_file, index_settings, full_rescan, full_rescan_days)
+    
+    scan_workers = max(1, int(config['general'].get('scan_workers', 1)))
+    if scan_workers > 1 and directories:
+        logger.info(f"使用 {scan_workers} 个线程并行扫描NAS目录")
+        scan_results = scan_nas_directories_parallel(
+            directories, size_threshold, exclude_matcher, ignore_links, scan_workers, scan_index,
+            settings['ignore_hardlinks'], scan_stats)
+    else:
+        scan_results = []
+        for directory in directories:
+            start_time = time.perf_counter()
+            scan_results.append(get_nas_files(directory, size_threshold, exclude_matcher, ignore_links, scan_index,
+                                              settings['ignore_hardlinks']))
+            if scan_stats is not None:
+                scan_stats[directory] = time.perf_counter() - start_time
     
-    # 找出在NAS文件列表中但不在做种文件列表中的文件
+    if scan_index is not None:
+        scan_index.save()
+    
+    return scan_results
+
+# 对比NAS文件清单和做种文件列表([SeedingFile])：两边各建一次哈希索引，一次遍历同时得到冗余、已匹配和做种但不在清单中的文件
+# 返回字典：
+#   redundant: 在NAS清单中但没有做种的文件 [(file_path, details)]，保持NAS清单的顺序
+#   matched: 在NAS清单中且正在做种的文件 [(file_path, details)]
+#   missing: 正在做种但不在NAS清单中的做种文件 [SeedingFile]，按规范化路径首次出现的顺序去重；清单只包含满足大小阈值的文件，
+#            因此这些只是丢失文件的候选，由 find_missing_seeding_files 进一步确认，已在清单中的做种文件无需再检查
+#   inode_matched: 路径未做种、但与做种文件是同一 inode 的硬链接而被视为做种的文件数
+#   inode_stats: 为确认NAS清单之外的做种文件 inode 而调用 stat 的次数
+#   timings: 每个阶段的耗时(秒)
+# inode_matching 为 True 时，同一文件的任一硬链接在做种，其他硬链接(例如媒体库中的副本)都视为做种；
+# 做种文件位于NAS清单之外时，只对大小与未匹配的多链接文件相同的做种文件 stat 一次取得 inode
+def reconcile(nas_files, seeding_files, inode_matching=False):
+    timings = {}
+    
+    start_time = time.perf_counter()
+    seeding_paths = {}
+    for seeding_file in seeding_files:
+        seeding_paths.setdefault(os.path.normpath(seeding_file.file_path), seeding_file)
+    timings['index_seeding'] = time.perf_counter() - start_time
+    
+    start_time = time.perf_counter()
     redundant_files = []
+    matched_files = []
+    nas_paths = set()
     for file_path, details in nas_files:
         norm_path = os.path.normpath(file_path)
-        if norm_path not in seeding_files_normalized:
+        nas_paths.add(norm_path)
+        if norm_path in seeding_paths:
+            matched_files.append((file_path, details))
+        else:
             redundant_files.append((file_path, details))
-    
-    return redundant_files
+    timings['match_nas'] = time.perf_counter() - start_time
+    
+    start_time = time.perf_counter()
+    missing_candidates = [seeding_file for norm_path, seeding_file in seeding_paths.items() if norm_path not in nas_paths]
+    timings['match_seeding'] = time.perf_counter() - start_time
+    
+    inode_matched = 0
+    inode_stats = 0
+    if inode_matching and redundant_files:
+        start_time = time.perf_counter()
+        # 没有 inode 信息的文件(读取文件信息出错等)不参与硬链接匹配
+        seeded_inodes = {get_inode_key(details) for _, details in matched_files}
+        seeded_inodes.discard(None)
+        
+        # 未匹配的多链接文件：inode -> 文件大小，做种副本可能位于未扫描的目录中
+        linked_inodes = {}
+        for _, details in redundant_files:
+            key = get_inode_key(details)
+            if key is not None and key not in seeded_inodes and details.nlink > 1:
+                linked_inodes[key] = details.size_bytes
+        
+        if linked_inodes:
+            linked_sizes = set(linked_inodes.values())
+            checked_paths = set()
+            for seeding_file in seeding_files:
+                if seeding_file.file_size not in linked_sizes:
+                    continue
+                norm_path = os.path.normpath(seeding_file.file_path)
+                if norm_path in nas_paths or norm_path in checked_paths:
+                    continue
+                checked_paths.add(norm_path)
+                inode_stats += 1
+                try:
+                    file_stat = os.stat(norm_path)
+                except OSError:
+                    continue
+                key = (file_stat.st_dev, file_stat.st_ino)
+                if key in linked_inodes:
+                    seeded_inodes.add(key)
+        
+        remaining_files = []
+        for file_path, details in redundant_files:
+            key = get_inode_key(details)
+            if key is not None and key in seeded_inodes:
+                matched_files.append((file_path, details))
+                inode_matched += 1
+            else:
+                remaining_files.append((file_path, details))
+        redundant_files = remaining_files
+        timings['match_inodes'] = time.perf_counter() - start_time
+    
+    return {
+        'redundant': redundant_files,
+        'matched': matched_files,
+        'missing': missing_candidates,
+        'inode_matched': inode_matched,
+        'inode_stats': inode_stats,
+        'timings': timings,
+    }
+
+# 文件详细信息中的 (st_dev, st_ino)，信息不完整时返回 None
+def get_inode_key(details):
+    if details.inode is None:
+        return None
+    return (details.device, details.inode)
+
+# 按 inode 累计冗余文件的占用空间和可回收空间，逐个添加文件，可以在写报告的同一次遍历中完成统计
+# 只有同一 inode 的所有硬链接都是冗余文件时，删除它们才能真正释放空间，否则只是减少一个链接
+class ReclaimableSpaceCounter:
+    def __init__(self):
+        self.unlinked_count = 0
+        self.unlinked_bytes = 0
+        self.inode_groups = {}
+    
+    def add(self, details):
+        key = get_inode_key(details)
+        if key is None:
+            self.unlinked_count += 1
+            self.unlinked_bytes += details.size_bytes
+            return
+        group = self.inode_groups.setdefault(key, [0, details.nlink, details.size_bytes])
+        group[0] += 1
+    
+    # 返回 (唯一 inode 数, 按 inode 去重后的占用空间, 可回收空间)
+    def result(self):
+        unique_count = self.unlinked_count
+        unique_bytes = self.unlinked_bytes
+        reclaimable_bytes = self.unlinked_bytes
+        for link_count, nlink, size_bytes in self.inode_groups.values():
+            unique_count += 1
+            unique_bytes += size_bytes
+            if link_count >= nlink:
+                reclaimable_bytes += size_bytes
+        return unique_count, unique_bytes, reclaimable_bytes
+
+# 按 inode 汇总冗余文件，返回 (唯一 inode 数, 按 inode 去重后的占用空间, 可回收空间)
+def summarize_reclaimable_space(redundant_files):
+    counter = ReclaimableSpaceCounter()
+    for _, details in redundant_files:
+        counter.add(details)
+    return counter.result()
+
+# 找出没有做种的冗余文件
+def find_redundant_files(nas_files, seeding_files):
+    return reconcile(nas_files, seeding_files)['redundant']
+
+# 目录列表缓存：检查做种文件是否存在时，每个上级目录只 scandir 一次，同一目录下的文件(剧集包、蓝光 STREAM 目录等)
+# 直接在缓存的列表中查找；不存在的目录也会被记住，并向上找到第一个存在的上级目录，
+# 整个被删除的种子目录只需一次失败的查询即可确定，只在一次检查中使用
+class DirectoryListingCache:
+    # 目录无法读取(权限等原因)时的标记，此时退回逐个 stat
+    UNREADABLE = object()
+    
+    def __init__(self):
+        # 目录 -> 其中的文件名集合，目录不存在时为 None
+        self.listings = {}
+        self.scandir_calls = 0
+        self.stat_calls = 0
+    
+    def get_listing(self, directory):
+        if directory in self.listings:
+            return self.listings[directory]
+        
+        # 最近一个已缓存的上级目录已确认不存在时，无需再查询
+        parent = os.path.dirname(directory)
+        ancestor = parent
+        while ancestor not in self.listings and os.path.dirname(ancestor) != ancestor:
+            ancestor = os.path.dirname(ancestor)
+        if self.listings.get(ancestor, self.UNREADABLE) is None:
+            self.listings[directory] = None
+            return None
+        
+        self.scandir_calls += 1
+        try:
+            with os.scandir(directory) as it:
+                listing = {entry.name for entry in it if entry.is_file()}
+        except (FileNotFoundError, NotADirectoryError):
+            self.listings[directory] = None
+            # 向上记住所有不存在的上级目录，同一个被删除目录下的其他子目录无需再次查询
+            if parent and parent != directory:
+                self.get_listing(parent)
+            return None
+        except OSError as e:
+            logger.debug(f"无法读取目录: {directory}, 错误: {str(e)}")
+            listing = self.UNREADABLE
+        self.listings[directory] = listing
+        return listing
+    
+    # 判断路径是否为存在的文件，结果与 os.path.isfile 一致
+    def is_file(self, path):
+        directory, name = os.path.split(path)
+        if not directory or not name:
+            self.stat_calls += 1
+            return os.path.isfile(path)
+        listing = self.get_listing(directory)
+        if listing is None:
+            return False
+        if listing is not self.UNREADABLE and name in listing:
+            return True
+        # 目录无法读取，或文件名不在列表中(可能是大小写不敏感的网络挂载)时以 stat 为准，丢失的文件很少，开销可以忽略
+        self.stat_calls += 1
+        return os.path.isfile(path)
 
 # 找出正在做种但已被删除的文件
-def find_missing_seeding_files(seeding_files, seeding_torrents):
+# 文件是否存在优先在本次扫描得到的NAS文件清单中判断，只有低于大小阈值或位于未扫描目录中的文件才访问磁盘
+# check_stats 不为空时记录清单确定的文件数、列出目录和单独 stat 的次数
+# unchecked_files 不为空时收集因不在NAS目录中而跳过的做种文件，用于诊断缺失或错误的路径映射
+def find_missing_seeding_files(seeding_files, nas_inventory, check_stats=None, unchecked_files=None):
     missing_files = []
     processed_paths = set()  # 用于去重
+    listing_cache = DirectoryListingCache()
+    inventory_checks = 0
     
-    # 获取配置中的NAS目录
-    config = load_config()
-    nas_dirs = []
-    if 'general' in config and 'nas_directories' in config['general']:
-        dirs_str = config['general']['nas_directories']
-        # 支持中英文逗号
-        dirs_str = dirs_str.replace('，', ',')
-        nas_dirs = [os.path.normpath(d.strip()) for d in dirs_str.split(',') if d.strip()]
-        logger.info(f"配置的NAS目录: {nas_dirs}")
-    
-    for i, file_path in enumerate(seeding_files):
+    # 扫描配置中的NAS目录
+    nas_dirs = nas_inventory.directories
+    logger.info(f"配置的NAS目录: {nas_dirs}")
+    
+    for seeding_file in seeding_files:
         # 规范化路径
-        norm_path = os.path.normpath(file_path)
+        norm_path = os.path.normpath(seeding_file.file_path)
         
         # 如果已经处理过此路径，则跳过
         if norm_path in processed_paths:
@@ -789,245 +2478,765 @@ def find_missing_seeding_files(seeding_files, seeding_torrents):
         # 如果文件不在配置的NAS目录中，跳过检查
         if not in_nas_dirs:
             logger.info(f"跳过检查非NAS目录文件: {norm_path}")
+            if unchecked_files is not None:
+                unchecked_files.append(seeding_file)
             continue
         
-        # 检查文件是否存在
-        if not os.path.exists(norm_path) or not os.path.isfile(norm_path):
-            try:
-                # 获取种子信息
-                if i < len(seeding_torrents):  # 确保有对应的种子信息
-                    torrent_info = seeding_torrents[i]
-                    
-                    # 标记为确实丢失，而不是路径问题
-                    is_real_missing = True
-                    
-                    # 获取原始路径(下载器内路径)，用于额外检查
-                    original_path = torrent_info.get('original_path', '')
-                    
-                    # 获取客户端ID和路径映射，用于详细日志
-                    client_id = torrent_info.get('client_id', '')
-                    path_mapping = torrent_info.get('path_mapping', '')
-                    
-                    logger.info(f"检测到可能丢失的文件: {norm_path} (原始路径: {original_path}, 客户端: {client_id})")
-                    if path_mapping:
-                        logger.info(f"使用的路径映射: {path_mapping}")
-                    
-                    # 额外检查，确认文件确实不存在（解决路径格式差异问题）
-                    alt_paths = [
-                        # 尝试替换斜杠
-                        norm_path.replace('\\', '/'),
-                        norm_path.replace('/', '\\'),
-                        # 尝试去除特殊字符
-                        os.path.normpath(re.sub(r'[^a-zA-Z0-9/\\._\-]', '_', file_path)),
-                        # 尝试按目录单独查找
-                        os.path.join(torrent_info['save_path'], torrent_info['file_name']),
-                        # 如果有原始路径，也尝试检查
-                        original_path
-                    ]
-                    
-                    # 检查替代路径是否存在
-                    for alt_path in alt_paths:
-                        if not alt_path:
-                            continue
-                        alt_norm_path = os.path.normpath(alt_path)
-                        if alt_norm_path != norm_path and alt_norm_path not in processed_paths:
-                            processed_paths.add(alt_norm_path)  # 添加到已处理路径
-                            if os.path.exists(alt_path) and os.path.isfile(alt_path):
-                                logger.info(f"文件通过替代路径找到: {alt_path} (原路径: {norm_path})")
-                                is_real_missing = False
-                                break
-                    
-                    if is_real_missing:
-                        logger.info(f"确认丢失的文件: {norm_path}")
-                        # 防止重复添加相同路径
-                        duplicate = False
-                        for existing in missing_files:
-                            if existing['file_path'] == torrent_info['file_path']:
-                                duplicate = True
-                                break
-                        if not duplicate:
-                            missing_files.append(torrent_info)
-                else:
-                    # 没有种子信息时的备用处理
-                    filename = os.path.basename(norm_path)
-                    directory = os.path.dirname(norm_path)
-                    extension = os.path.splitext(filename)[1][1:] if os.path.splitext(filename)[1] else ""
-                    
-                    # 检查是否重复
-                    duplicate = False
-                    for existing in missing_files:
-                        if existing.get('file_path') == norm_path:
-                            duplicate = True
-                            break
-                    
-                    if not duplicate:
-                        missing_files.append({
-                            'file_path': norm_path,
-                            'file_name': filename,
-                            'file_size': 0,
-                            'file_size_human': "未知",
-                            'torrent_name': "未知",
-                            'torrent_hash': "未知",
-                            'torrent_state': "未知",
-                            'save_path': directory,
-                            'client_type': "未知",
-                            'client_id': "",
-                            'client_host': "",
-                            'extension': extension
-                        })
-            except Exception as e:
-                logger.warning(f"处理缺失文件时出错: {norm_path}, 错误: {str(e)}")
-                import traceback
-                logger.warning(traceback.format_exc())
-    
+        # 检查文件是否存在，清单无法确定时再检查磁盘
+        exists = nas_inventory.lookup(norm_path)
+        if exists is None:
+            exists = listing_cache.is_file(norm_path)
+        else:
+            inventory_checks += 1
+        if not exists:
+            # 原始路径(下载器内路径)和路径映射，用于详细日志
+            client = seeding_file.client
+            logger.info(f"确认丢失的文件: {norm_path} (原始路径: {seeding_file.original_path}, 客户端: {client.client_id})")
+            if client.path_mapping:
+                logger.info(f"使用的路径映射: {client.path_mapping}")
+            missing_files.append(seeding_file)
+    
+    if check_stats is not None:
+        check_stats.update({'inventory_checks': inventory_checks, 'scandir_calls': listing_cache.scandir_calls,
+                            'stat_calls': listing_cache.stat_calls})
+    logger.info(f"检查做种文件是否存在: {inventory_checks} 个文件由NAS清单确定, 其余列出 "
+                f"{listing_cache.scandir_calls} 个目录, 单独 stat {listing_cache.stat_calls} 个文件")
     return missing_files
 
-# 格式化输出文件
-def format_output(redundant_files, nas_files_count, seeding_files_count):
-    output = []
+# 模糊匹配索引：按 (文件大小, 文件名) 以及 (文件大小, Unicode规范化并忽略大小写的文件名) 索引NAS文件，
+# 用于在内存中找出路径不同、但实际是同一文件的做种文件和NAS文件(通常是 path_mappings 配置错误)
+class FuzzyMatchIndex:
+    def __init__(self, nas_files):
+        self.exact = {}
+        self.normalized = {}
+        self.used_paths = set()
+        for file_path, details in nas_files:
+            name = os.path.basename(file_path)
+            size_bytes = details.size_bytes
+            self.exact.setdefault((size_bytes, name), []).append(file_path)
+            self.normalized.setdefault((size_bytes, self.normalize_name(name)), []).append(file_path)
+    
+    # 统一 NFC/NFD 形式并忽略大小写，macOS 和部分下载器会以 NFD 形式保存文件名
+    @staticmethod
+    def normalize_name(name):
+        return unicodedata.normalize('NFC', name).casefold()
+    
+    # 两个路径从末尾开始相同的路径组件数
+    @classmethod
+    def common_suffix_length(cls, parts_a, parts_b):
+        length = 0
+        while (length < len(parts_a) and length < len(parts_b) and
+               cls.normalize_name(parts_a[-1 - length]) == cls.normalize_name(parts_b[-1 - length])):
+            length += 1
+        return length
+    
+    # 为做种文件找到大小和文件名相同的NAS文件，有多个候选时选择末尾相同路径最长的一个，每个NAS文件只匹配一次
+    def match(self, file_path, file_size):
+        if not file_size:
+            return None
+        name = os.path.basename(file_path)
+        candidates = [path for path in self.exact.get((file_size, name), []) if path not in self.used_paths]
+        if not candidates:
+            candidates = [path for path in self.normalized.get((file_size, self.normalize_name(name)), [])
+                          if path not in self.used_paths]
+        if not candidates:
+            return None
+        
+        parts = PathMapper.split_path(os.path.normpath(file_path))
+        best_path = max(candidates, key=lambda path: self.common_suffix_length(
+            parts, PathMapper.split_path(os.path.normpath(path))))
+        self.used_paths.add(best_path)
+        return best_path
+
+# 根据同一文件的下载器路径和NAS路径推断路径映射：去掉末尾相同的路径组件，剩下的前缀即为映射规则的两端
+def derive_path_mapping(source_path, nas_path):
+    source_parts = PathMapper.split_path(os.path.normpath(source_path))
+    nas_parts = PathMapper.split_path(os.path.normpath(nas_path))
+    length = FuzzyMatchIndex.common_suffix_length(source_parts, nas_parts)
+    # 至少保留一个前缀组件
+    length = min(length, len(source_parts) - 1, len(nas_parts) - 1)
+    return os.path.join(*source_parts[:len(source_parts) - length]), os.path.join(*nas_parts[:len(nas_parts) - length])
+
+# 用模糊匹配索引诊断路径映射错误：丢失的做种文件，以及因不在NAS目录中而未检查的做种文件(映射缺失或指向NAS目录之外)，
+# 在冗余文件中找到大小和文件名相同的文件时，按下载器和推断出的路径映射 (下载器路径, NAS路径) 分组，作为路径映射建议列出。
+# resolve 为 True 时，一组中NAS目录内的丢失文件至少有 min_matches 个被匹配，且多于该下载器路径下在NAS中找到的做种文件，
+# 才视为映射错误，把这些丢失文件和对应的NAS文件从两个列表中移除。未检查的做种文件只产生建议，不会排除任何结果：
+# 下载器可能在NAS目录之外的卷上做种，而NAS中另有一份同名同大小、但不是硬链接的副本，这些副本是真正的冗余文件
+# seeding_files 为全部做种文件，用于统计各下载器路径下在NAS中找到的文件数
+# 返回 (冗余文件, 丢失文件, 路径映射建议 {client_id: {(下载器路径, NAS路径): (文件数, 是否已排除)}})
+def resolve_fuzzy_matches(redundant_files, missing_files, unchecked_files=(), seeding_files=(), min_matches=3,
+                          resolve=False):
+    candidates = list(missing_files) + list(unchecked_files)
+    if not redundant_files or not candidates:
+        return redundant_files, missing_files, {}
+    
+    start_time = time.perf_counter()
+    index = FuzzyMatchIndex(redundant_files)
+    groups = {}
+    missing_ids = {id(seeding_file) for seeding_file in missing_files}
+    for seeding_file in candidates:
+        nas_path = index.match(seeding_file.file_path, seeding_file.file_size)
+        if nas_path is None:
+            continue
+        source_path = seeding_file.original_path or seeding_file.file_path
+        logger.info(f"模糊匹配: 做种文件 {source_path} 对应NAS文件 {nas_path}")
+        client_id = seeding_file.client.client_id or seeding_file.client.client_type
+        key = (client_id, derive_path_mapping(source_path, nas_path))
+        groups.setdefault(key, []).append((seeding_file, nas_path, id(seeding_file) in missing_ids))
+    
+    # 统计每组下载器路径下在NAS中找到的做种文件数，映射错误时这些路径下的文件几乎都找不到
+    source_prefixes = {}
+    for client_id, (source_prefix, _) in groups:
+        source_prefixes.setdefault(client_id, set()).add(source_prefix)
+    candidate_ids = {id(seeding_file) for seeding_file in candidates}
+    found_counts = {}
+    for seeding_file in seeding_files:
+        client_id = seeding_file.client.client_id or seeding_file.client.client_type
+        prefixes = source_prefixes.get(client_id)
+        if not prefixes or id(seeding_file) in candidate_ids:
+            continue
+        parent = os.path.normpath(seeding_file.original_path or seeding_file.file_path)
+        while True:
+            next_parent = os.path.dirname(parent)
+            if next_parent == parent:
+                break
+            parent = next_parent
+            if parent in prefixes:
+                found_counts[(client_id, parent)] = found_counts.get((client_id, parent), 0) + 1
+    
+    resolved_files = set()
+    resolved_paths = set()
+    suggestions = {}
+    for (client_id, mapping), matches in groups.items():
+        missing_matches = [(seeding_file, nas_path) for seeding_file, nas_path, is_missing in matches if is_missing]
+        applied = (resolve and len(missing_matches) >= min_matches and
+                   len(missing_matches) > found_counts.get((client_id, mapping[0]), 0))
+        if applied:
+            for seeding_file, nas_path in missing_matches:
+                resolved_files.add(id(seeding_file))
+                resolved_paths.add(nas_path)
+        suggestions.setdefault(client_id, {})[mapping] = (len(matches), applied)
+    
+    remaining_redundant = [(file_path, details) for file_path, details in redundant_files
+                           if file_path not in resolved_paths]
+    remaining_missing = [seeding_file for seeding_file in missing_files if id(seeding_file) not in resolved_files]
+    logger.info(f"模糊匹配完成: {len(index.used_paths)} 个文件路径不同但大小和文件名相同, "
+                f"其中 {len(resolved_paths)} 个按路径映射错误排除, 耗时 {time.perf_counter() - start_time:.3f} 秒")
+    return remaining_redundant, remaining_missing, suggestions
+
+# 格式化路径映射建议
+def format_mapping_suggestions(mapping_suggestions):
+    output = ["路径映射建议(以下做种文件与NAS文件大小和文件名相同、路径不同):"]
+    for client_id, client_suggestions in mapping_suggestions.items():
+        for (source_prefix, nas_prefix), (count, applied) in sorted(client_suggestions.items(),
+                                                                     key=lambda item: -item[1][0]):
+            note = "已从冗余和丢失列表中排除" if applied else "仅供参考，未从列表中排除"
+            output.append(f"  {client_id}: {source_prefix} → {nas_prefix} 匹配 {count:,} 个文件，{note}")
+    return output
+
+# 格式化下载器获取结果摘要，失败或超时的下载器会导致结果不完整
+def format_client_summary(client_stats):
+    output = ["下载器状态:"]
+    for client_id, stats in client_stats.items():
+        line = f"  {client_id}: {stats.get('status', '未知')}"
+        if 'elapsed' in stats:
+            line += f", 耗时 {stats['elapsed']:.1f} 秒"
+        output.append(line)
+    if any(not stats.get('success') for stats in client_stats.values()):
+        output.append("警告：部分下载器获取失败，其做种文件可能被误报为冗余文件，且其丢失文件未被检查")
+    return output
+
+# 统计冗余文件的总大小、按inode去重的占用空间、可回收空间和文件类型，报告标题部分和汇总信息文件共用这些统计
+def summarize_redundant_files(redundant_files):
+    total_size = 0
+    file_types = {}
+    reclaimable_counter = ReclaimableSpaceCounter()
+    for _, details in redundant_files:
+        total_size += details.size_bytes
+        file_types[details.file_type] = file_types.get(details.file_type, 0) + 1
+        reclaimable_counter.add(details)
+    unique_count, unique_bytes, reclaimable_bytes = reclaimable_counter.result()
+    return {
+        'redundant_files': len(redundant_files),
+        'total_bytes': total_size,
+        'unique_files': unique_count,
+        'unique_bytes': unique_bytes,
+        'reclaimable_bytes': reclaimable_bytes,
+        'file_types': file_types,
+    }
+
+# 逐行生成冗余文件报告：先统计汇总信息写在报告开头，再逐个写出文件列表，内存中不保留完整报告；
+# 汇总信息同时以原始数值保存到 summary 字典中，供写入汇总信息文件
+def iter_redundant_report_lines(redundant_files, nas_files_count, seeding_files_count, client_stats=None,
+                                mapping_suggestions=None, summary=None):
+    if summary is None:
+        summary = {}
+    check_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    summary.update({'check_time': check_time, 'nas_files': nas_files_count, 'seeding_files': seeding_files_count})
+    summary.update(summarize_redundant_files(redundant_files))
     
     # 标题
-    output.append("=" * 80)
-    output.append("                       NAS 冗余文件检查报告                           ")
-    output.append("=" * 80)
+    yield "=" * 80
+    yield "                       NAS 冗余文件检查报告                           "
+    yield "=" * 80
     
     # 基本信息
-    output.append(f"检查时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    output.append(f"总NAS文件数: {nas_files_count}")
-    output.append(f"做种文件数: {seeding_files_count}")
-    output.append(f"冗余文件数: {len(redundant_files)}")
-    output.append("-" * 80)
+    yield f"检查时间: {check_time}"
+    yield f"总NAS文件数: {nas_files_count}"
+    yield f"做种文件数: {seeding_files_count}"
+    yield f"冗余文件数: {len(redundant_files)}"
+    if client_stats:
+        yield from format_client_summary(client_stats)
+    if mapping_suggestions:
+        yield from format_mapping_suggestions(mapping_suggestions)
+    yield "-" * 80
     
     # 汇总信息
-    total_size = sum(details['size_bytes'] for _, details in redundant_files)
-    output.append(f"冗余文件总大小: {humanize.naturalsize(total_size, binary=True)}")
+    yield f"冗余文件总大小: {humanize.naturalsize(summary['total_bytes'], binary=True)}"
+    if summary['unique_files'] != len(redundant_files):
+        yield (f"按inode去重: {summary['unique_files']} 个文件, "
+               f"占用 {humanize.naturalsize(summary['unique_bytes'], binary=True)}")
+    yield (f"可回收空间: {humanize.naturalsize(summary['reclaimable_bytes'], binary=True)}"
+           f"(同一文件的硬链接只计算一次，仍有硬链接不在冗余列表中的文件不计入)")
     
     # 按文件类型汇总
-    file_types = {}
-    for _, details in redundant_files:
-        file_type = details['file_type']
-        if file_type in file_types:
-            file_types[file_type] += 1
-        else:
-            file_types[file_type] = 1
-    
-    output.append("\n文件类型统计:")
-    for file_type, count in file_types.items():
-        output.append(f"  {file_type}: {count} 个文件")
+    yield "\n文件类型统计:"
+    for file_type, count in summary['file_types'].items():
+        yield f"  {file_type}: {count} 个文件"
     
     # 冗余文件列表
-    output.append("\n" + "=" * 80)
-    output.append("冗余文件列表:")
-    output.append("-" * 80)
+    yield "\n" + "=" * 80
+    yield "冗余文件列表:"
+    yield "-" * 80
     
-    # 文件列表
     for i, (file_path, details) in enumerate(redundant_files, 1):
         # 获取文件名和目录
         filename = os.path.basename(file_path)
         directory = os.path.dirname(file_path)
         
-        output.append(f"[{i}] {filename}")
-        output.append(f"    路径: {directory}")
-        output.append(f"    大小: {details['size_human']} | 类型: {details['file_type']} | 扩展名: {details['extension']}")
-        output.append(f"    创建时间: {details['create_time']} | 修改时间: {details['modify_time']}")
-        output.append("-" * 80)
-    
-    return "\n".join(output)
+        yield f"[{i}] {filename}"
+        yield f"    路径: {directory}"
+        line = f"    大小: {details.size_human} | 类型: {details.file_type} | 扩展名: {details.extension}"
+        if details.nlink > 1:
+            line += f" | 硬链接数: {details.nlink}"
+        yield line
+        yield f"    创建时间: {details.create_time} | 修改时间: {details.modify_time}"
+        yield "-" * 80
 
-# 格式化已删除的做种文件输出
-def format_missing_seeding_output(missing_files):
-    if not missing_files:
-        return "未发现正在做种但已删除的文件。"
+# 格式化输出文件
+def format_output(redundant_files, nas_files_count, seeding_files_count, client_stats=None, mapping_suggestions=None):
+    return "\n".join(iter_redundant_report_lines(redundant_files, nas_files_count, seeding_files_count,
+                                                 client_stats, mapping_suggestions))
+
+# 统计已删除的做种文件的总大小，以及按下载器类型、种子状态和扩展名的文件数
+def summarize_missing_files(missing_files):
+    total_size = 0
+    client_type_stats = {}
+    state_stats = {}
+    ext_stats = {}
+    for file in missing_files:
+        torrent = file.torrent
+        ext = file.file_path.split('.')[-1].lower() if '.' in file.file_path else ""
+        total_size += file.file_size or 0
+        client_type_stats[torrent.client.client_type] = client_type_stats.get(torrent.client.client_type, 0) + 1
+        state_stats[torrent.state] = state_stats.get(torrent.state, 0) + 1
+        ext_stats[ext] = ext_stats.get(ext, 0) + 1
+    return {
+        'missing_files': len(missing_files),
+        'total_bytes': total_size,
+        'client_types': client_type_stats,
+        'torrent_states': state_stats,
+        'extensions': ext_stats,
+    }
+
+# 逐行生成已删除的做种文件报告，汇总信息的统计方式与 iter_redundant_report_lines 相同
+def iter_missing_report_lines(missing_files, client_stats=None, mapping_suggestions=None, summary=None):
+    if summary is None:
+        summary = {}
+    check_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    summary['check_time'] = check_time
+    summary.update(summarize_missing_files(missing_files))
     
-    output = []
+    if not missing_files:
+        yield "未发现正在做种但已删除的文件。"
+        if client_stats:
+            yield from format_client_summary(client_stats)
+        if mapping_suggestions:
+            yield from format_mapping_suggestions(mapping_suggestions)
+        return
     
     # 标题
-    output.append("=" * 80)
-    output.append("                正在做种但已删除的文件列表                           ")
-    output.append("=" * 80)
+    yield "=" * 80
+    yield "                正在做种但已删除的文件列表                           "
+    yield "=" * 80
     
     # 基本信息
-    output.append(f"检查时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    output.append(f"已删除文件数: {len(missing_files)}")
-    output.append("-" * 80)
-    output.append("注意：此列表只包含配置的NAS目录中丢失的文件，不包含未配置监控的目录")
+    yield f"检查时间: {check_time}"
+    yield f"已删除文件数: {len(missing_files)}"
+    if client_stats:
+        yield from format_client_summary(client_stats)
+    if mapping_suggestions:
+        yield from format_mapping_suggestions(mapping_suggestions)
+    yield "-" * 80
+    yield "注意：此列表只包含配置的NAS目录中丢失的文件，不包含未配置监控的目录"
     
-    # 总计大小
-    total_size = sum(file.get('file_size', 0) for file in missing_files)
-    output.append(f"总文件大小: {humanize.naturalsize(total_size, binary=True)}")
+    # 汇总信息
+    yield f"总文件大小: {humanize.naturalsize(summary['total_bytes'], binary=True)}"
     
     # 按下载器类型分组统计
-    client_stats = {}
-    for file in missing_files:
-        client = file.get('client_type', "未知")
-        if client in client_stats:
-            client_stats[client] += 1
-        else:
-            client_stats[client] = 1
-    
-    output.append("\n下载器统计:")
-    for client, count in client_stats.items():
-        output.append(f"  {client}: {count} 个文件")
+    yield "\n下载器统计:"
+    for client_type, count in summary['client_types'].items():
+        yield f"  {client_type}: {count} 个文件"
     
     # 按种子状态分组统计
-    state_stats = {}
-    for file in missing_files:
-        state = file.get('torrent_state', "未知")
-        if state in state_stats:
-            state_stats[state] += 1
-        else:
-            state_stats[state] = 1
-    
-    output.append("\n种子状态统计:")
-    for state, count in state_stats.items():
-        output.append(f"  {state}: {count} 个文件")
+    yield "\n种子状态统计:"
+    for state, count in summary['torrent_states'].items():
+        yield f"  {state}: {count} 个文件"
     
     # 按文件类型统计
-    ext_stats = {}
-    for file in missing_files:
-        ext = file.get('extension', file.get('file_path', "").split('.')[-1] if '.' in file.get('file_path', "") else "").lower()
-        if ext in ext_stats:
-            ext_stats[ext] += 1
-        else:
-            ext_stats[ext] = 1
-    
-    output.append("\n文件类型统计:")
-    for ext, count in ext_stats.items():
+    yield "\n文件类型统计:"
+    for ext, count in summary['extensions'].items():
         ext_display = ext if ext else "无扩展名"
-        output.append(f"  {ext_display}: {count} 个文件")
+        yield f"  {ext_display}: {count} 个文件"
     
-    # 已删除的做种文件列表
-    output.append("\n" + "=" * 80)
-    output.append("已删除的做种文件详细列表:")
-    output.append("-" * 80)
+    # 已删除的做种文件详细列表
+    yield "\n" + "=" * 80
+    yield "已删除的做种文件详细列表:"
+    yield "-" * 80
     
-    # 文件列表
     for i, file in enumerate(missing_files, 1):
-        output.append(f"[{i}] {file.get('file_name', os.path.basename(file.get('file_path', 'Unknown')))}")
-        output.append(f"    文件路径: {file.get('file_path', '未知')}")
-        output.append(f"    保存位置: {file.get('save_path', '未知')}")
-        output.append(f"    文件大小: {file.get('file_size_human', '未知')}")
+        torrent = file.torrent
+        client = torrent.client
+        yield f"[{i}] {file.file_name}"
+        yield f"    文件路径: {file.file_path}"
+        yield f"    保存位置: {torrent.save_path}"
+        yield f"    文件大小: {file.file_size_human}"
         
         # 种子信息
-        torrent_name = file.get('torrent_name', '未知')
-        torrent_hash = file.get('torrent_hash', '未知')
-        torrent_state = file.get('torrent_state', '未知')
-        output.append(f"    种子名称: {torrent_name}")
-        output.append(f"    种子状态: {torrent_state}")
-        output.append(f"    种子哈希: {torrent_hash[:8]}{'...' if len(torrent_hash) > 8 else ''}")
+        yield f"    种子名称: {torrent.name}"
+        yield f"    种子状态: {torrent.state}"
+        yield f"    种子哈希: {torrent.hash[:8]}{'...' if len(torrent.hash) > 8 else ''}"
         
         # 下载器信息
-        client_type = file.get('client_type', '未知')
-        client_id = file.get('client_id', '')
-        client_host = file.get('client_host', '未知')
-        output.append(f"    下载器: {client_type}{f' ({client_id})' if client_id else ''} - {client_host}")
+        yield f"    下载器: {client.client_type}{f' ({client.client_id})' if client.client_id else ''} - {client.client_host}"
         
-        output.append("-" * 80)
+        yield "-" * 80
+
+# 格式化已删除的做种文件输出
+def format_missing_seeding_output(missing_files, client_stats=None, mapping_suggestions=None):
+    return "\n".join(iter_missing_report_lines(missing_files, client_stats, mapping_suggestions))
+
+# 保存一份报告及其汇总信息文件，写入失败时改为保存到备选位置
+# make_lines(summary) 每次调用都重新生成报告行，重试时不需要在内存中保留完整的报告
+def save_report(description, file_path, fallback_path, make_lines):
+    for path in dict.fromkeys((file_path, fallback_path)):
+        try:
+            if path != file_path:
+                logger.info(f"尝试保存{description}到备选位置: {path}")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            summary = {}
+            write_report_atomic(path, make_lines(summary))
+            save_json_atomic(get_report_summary_path(path), summary)
+            logger.info(f"{description}已保存到: {path}")
+            return path
+        except Exception as e:
+            logger.error(f"保存{description}时出错: {path}, 错误: {str(e)}")
+    
+    logger.error(f"保存{description}到备选位置也失败，直接打印结果:")
+    for line in make_lines({}):
+        logger.info(line)
+    return None
+
+# 检查结果数据库：每次检查的冗余文件和丢失文件都记录在输出目录的 results.db 中，
+# 用于生成与上次检查相比的变化报告，以及不解析报告文本直接查询历史结果
+#   runs: 每次检查一行，包括时间、文件数和总大小，以及获取失败的下载器
+#   findings: 每次检查的每个结果一行，kind 为 redundant 或 missing，丢失文件记录种子哈希和下载器ID
+class ResultsStore:
+    KINDS = ('redundant', 'missing')
+    
+    def __init__(self, db_path, keep_runs=30):
+        self.db_path = db_path
+        self.keep_runs = keep_runs
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "run_id INTEGER PRIMARY KEY, started_at INTEGER NOT NULL, nas_files INTEGER NOT NULL, "
+            "seeding_files INTEGER NOT NULL, redundant_files INTEGER NOT NULL, redundant_bytes INTEGER NOT NULL, "
+            "missing_files INTEGER NOT NULL, missing_bytes INTEGER NOT NULL, failed_clients TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS findings ("
+            "run_id INTEGER NOT NULL, kind TEXT NOT NULL, file_path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "torrent_hash TEXT, client_id TEXT, PRIMARY KEY (run_id, kind, file_path)) WITHOUT ROWID")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS findings_client ON findings (client_id, kind, run_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS findings_path ON findings (file_path)")
+        self.conn.commit()
+    
+    # 记录一次检查的结果，返回新的 run_id；超过 keep_runs 的旧记录会被删除
+    def record_run(self, nas_files_count, seeding_files_count, redundant_files, missing_files, failed_clients=()):
+        cursor = self.conn.execute(
+            "INSERT INTO runs (started_at, nas_files, seeding_files, redundant_files, redundant_bytes, "
+            "missing_files, missing_bytes, failed_clients) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (int(time.time()), nas_files_count, seeding_files_count,
+             len(redundant_files), sum(details.size_bytes for _, details in redundant_files),
+             len(missing_files), sum(file.file_size or 0 for file in missing_files), ','.join(failed_clients)))
+        run_id = cursor.lastrowid
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO findings (run_id, kind, file_path, size, torrent_hash, client_id) "
+            "VALUES (?, 'redundant', ?, ?, NULL, NULL)",
+            ((run_id, file_path, details.size_bytes) for file_path, details in redundant_files))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO findings (run_id, kind, file_path, size, torrent_hash, client_id) "
+            "VALUES (?, 'missing', ?, ?, ?, ?)",
+            ((run_id, file.file_path, file.file_size or 0, file.torrent.hash, file.client.client_id)
+             for file in missing_files))
+        if self.keep_runs > 0:
+            self.conn.execute("DELETE FROM runs WHERE run_id <= ?", (run_id - self.keep_runs,))
+            self.conn.execute("DELETE FROM findings WHERE run_id <= ?", (run_id - self.keep_runs,))
+        self.conn.commit()
+        return run_id
+    
+    # 返回某次检查的记录 {列名: 值}，run_id 为空时返回最近一次检查，没有记录时返回 None
+    def get_run(self, run_id=None):
+        if run_id is None:
+            cursor = self.conn.execute("SELECT * FROM runs ORDER BY run_id DESC LIMIT 1")
+        else:
+            cursor = self.conn.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+    
+    # 上一次检查的 run_id，没有时返回 None
+    def get_previous_run_id(self, run_id):
+        row = self.conn.execute("SELECT MAX(run_id) FROM runs WHERE run_id < ?", (run_id,)).fetchone()
+        return row[0]
+    
+    def list_runs(self, limit=30):
+        return self.conn.execute(
+            "SELECT run_id, started_at, redundant_files, redundant_bytes, missing_files, missing_bytes, failed_clients "
+            "FROM runs ORDER BY run_id DESC LIMIT ?", (limit,)).fetchall()
+    
+    # 查询某次检查的结果，返回 (file_path, size, torrent_hash, client_id) 的迭代器，按路径排序
+    def iter_findings(self, run_id, kind, client_id=None):
+        query = "SELECT file_path, size, torrent_hash, client_id FROM findings WHERE run_id = ? AND kind = ?"
+        params = [run_id, kind]
+        if client_id:
+            query += " AND client_id = ?"
+            params.append(client_id)
+        return self.conn.execute(query + " ORDER BY file_path", params)
+    
+    # 在 run_id 中出现、但不在 other_run_id 中的结果；other_run_id 为空时返回 run_id 的全部结果
+    def iter_difference(self, run_id, other_run_id, kind):
+        if other_run_id is None:
+            return self.iter_findings(run_id, kind)
+        return self.conn.execute(
+            "SELECT f.file_path, f.size, f.torrent_hash, f.client_id FROM findings f "
+            "WHERE f.run_id = ? AND f.kind = ? AND NOT EXISTS ("
+            "SELECT 1 FROM findings p WHERE p.run_id = ? AND p.kind = f.kind AND p.file_path = f.file_path) "
+            "ORDER BY f.file_path", (run_id, kind, other_run_id))
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+# 打开输出目录中的检查结果数据库，results_db 关闭或打开失败时返回 None
+def open_results_store(config):
+    if config['general'].get('results_db', 'true').lower() not in ('true', 'yes', '1', 'on'):
+        return None
+    db_path = os.path.join(get_state_directory(config), 'results.db')
+    try:
+        return ResultsStore(db_path, int(config['general'].get('results_keep_runs', 30)))
+    except Exception as e:
+        logger.error(f"打开检查结果数据库出错: {db_path}, 错误: {str(e)}")
+        return None
+
+# 逐行生成变化报告：与上次检查相比新增和已解决的冗余文件、丢失文件，数据直接从结果数据库中流式读取
+def iter_delta_report_lines(results_store, run_id, previous_run_id, client_stats=None, summary=None):
+    if summary is None:
+        summary = {}
+    check_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    return "\n".join(output)
+    # 标题
+    yield "=" * 80
+    yield "                       检查结果变化报告                           "
+    yield "=" * 80
+    
+    # 基本信息
+    yield f"检查时间: {check_time}"
+    previous_run = results_store.get_run(previous_run_id) if previous_run_id is not None else None
+    if previous_run is None:
+        yield "没有上次检查的记录，本次的全部结果都列为新增"
+    else:
+        previous_time = datetime.fromtimestamp(previous_run['started_at']).strftime('%Y-%m-%d %H:%M:%S')
+        yield f"对比的上次检查: #{previous_run_id} ({previous_time})"
+        if previous_run['failed_clients']:
+            yield f"警告：上次检查中以下下载器获取失败，其结果可能不完整: {previous_run['failed_clients']}"
+    if client_stats:
+        yield from format_client_summary(client_stats)
+    
+    sections = (
+        ('new_redundant', "新增的冗余文件", run_id, previous_run_id, 'redundant'),
+        ('resolved_redundant', "已不再冗余的文件(已删除或开始做种)", previous_run_id, run_id, 'redundant'),
+        ('new_missing', "新增的已删除做种文件", run_id, previous_run_id, 'missing'),
+        ('resolved_missing', "已恢复或不再做种的文件", previous_run_id, run_id, 'missing'),
+    )
+    for key, title, base_run_id, other_run_id, kind in sections:
+        yield "\n" + "=" * 80
+        yield f"{title}:"
+        yield "-" * 80
+        count = 0
+        total_size = 0
+        if base_run_id is not None:
+            for file_path, size, torrent_hash, client_id in results_store.iter_difference(base_run_id, other_run_id, kind):
+                count += 1
+                total_size += size
+                line = f"  {file_path} | {humanize.naturalsize(size, binary=True)}"
+                if client_id:
+                    line += f" | 下载器: {client_id} | 种子哈希: {torrent_hash[:8]}"
+                yield line
+        yield f"共 {count} 个文件, {humanize.naturalsize(total_size, binary=True)}"
+        summary[key] = count
+        summary[f"{key}_bytes"] = total_size
+    
+    summary.update({'check_time': check_time, 'run_id': run_id, 'previous_run_id': previous_run_id})
+
+# 命令行查询检查结果数据库，例如 --query missing --client qb2 列出最近一次检查中 qb2 的丢失文件
+def query_results(config, kind, client_id=None, run_id=None):
+    db_path = os.path.join(get_state_directory(config), 'results.db')
+    if not os.path.exists(db_path):
+        print(f"检查结果数据库不存在: {db_path}")
+        return
+    results_store = ResultsStore(db_path, keep_runs=0)
+    try:
+        if kind == 'runs':
+            for run in results_store.list_runs():
+                started_at = datetime.fromtimestamp(run[1]).strftime('%Y-%m-%d %H:%M:%S')
+                print(f"#{run[0]}\t{started_at}\t冗余 {run[2]} 个 {humanize.naturalsize(run[3], binary=True)}\t"
+                      f"丢失 {run[4]} 个 {humanize.naturalsize(run[5], binary=True)}"
+                      + (f"\t失败的下载器: {run[6]}" if run[6] else ""))
+            return
+        run = results_store.get_run(run_id)
+        if run is None:
+            print("没有找到检查记录")
+            return
+        count = 0
+        for file_path, size, torrent_hash, finding_client_id in results_store.iter_findings(run['run_id'], kind, client_id):
+            count += 1
+            print('\t'.join(str(value) for value in (file_path, size, torrent_hash or '', finding_client_id or '')))
+        print(f"# 检查 #{run['run_id']}: {count} 个文件", file=sys.stderr)
+    finally:
+        results_store.close()
+
+# 运行指标的名称、类型和说明，按此顺序输出，名称统一加 seeding_checker_ 前缀
+METRIC_DEFINITIONS = {
+    'check_runs_total': ('counter', '启动以来执行的检查次数'),
+    'check_last_run_timestamp_seconds': ('gauge', '最近一次检查完成的时间'),
+    'check_last_run_success': ('gauge', '最近一次检查是否成功，任一下载器获取失败或报告保存失败时为 0'),
+    'stage_duration_seconds': ('gauge', '最近一次检查各阶段的耗时'),
+    'client_fetch_duration_seconds': ('gauge', '最近一次检查获取各下载器做种文件的耗时'),
+    'client_fetch_success': ('gauge', '最近一次检查获取各下载器做种文件是否成功'),
+    'client_seeding_files': ('gauge', '最近一次检查各下载器的做种文件数'),
+    'client_http_requests_total': ('counter', '请求各下载器的累计次数'),
+    'client_http_received_bytes_total': ('counter', '从各下载器接收的累计字节数'),
+    'client_fetch_errors_total': ('counter', '获取各下载器做种文件失败的累计次数'),
+    'scan_duration_seconds': ('gauge', '最近一次检查扫描各NAS目录的耗时'),
+    'scan_files': ('gauge', '最近一次检查各NAS目录中超过大小阈值的文件数'),
+    'scan_directories': ('gauge', '最近一次检查各NAS目录中扫描的子目录数'),
+    'scan_stat_calls_total': ('counter', '扫描各NAS目录的累计 stat 调用次数'),
+    'scan_errors_total': ('counter', '扫描各NAS目录时出错的累计次数'),
+    'nas_files': ('gauge', '最近一次检查的NAS文件数'),
+    'seeding_files': ('gauge', '最近一次检查的做种文件数'),
+    'redundant_files': ('gauge', '最近一次检查的冗余文件数'),
+    'redundant_bytes': ('gauge', '最近一次检查的冗余文件总大小'),
+    'missing_files': ('gauge', '最近一次检查正在做种但已删除的文件数'),
+    'missing_check_stat_calls_total': ('counter', '检查做种文件是否存在时单独 stat 的累计次数'),
+    'missing_check_scandir_calls_total': ('counter', '检查做种文件是否存在时列出目录的累计次数'),
+    'report_errors_total': ('counter', '报告或导出文件未能保存到配置位置的累计次数'),
+}
+
+# 运行指标：gauge 为最近一次检查的值，每次检查结束后整体替换；counter 为进程启动以来的累计值
+# 样本以 (名称, ((标签名, 标签值), ...)) 为键，由检查线程发布，由HTTP线程读取
+class MetricsRegistry:
+    PREFIX = 'seeding_checker_'
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.counters = {}
+    
+    # 发布一次检查的指标
+    def publish(self, gauges, counters):
+        with self.lock:
+            self.gauges = dict(gauges)
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+    
+    # 按 Prometheus 文本格式逐行输出
+    def iter_lines(self):
+        with self.lock:
+            samples = dict(self.counters)
+            samples.update(self.gauges)
+        by_name = {}
+        for (name, labels), value in samples.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            if name not in by_name:
+                continue
+            full_name = self.PREFIX + name
+            yield f"# HELP {full_name} {help_text}"
+            yield f"# TYPE {full_name} {metric_type}"
+            for labels, value in sorted(by_name[name]):
+                if labels:
+                    label_text = ','.join(f'{key}="{escape_metric_label(label_value)}"' for key, label_value in labels)
+                    yield f"{full_name}{{{label_text}}} {value}"
+                else:
+                    yield f"{full_name} {value}"
+    
+    def render(self):
+        return ''.join(f"{line}\n" for line in self.iter_lines())
+
+# 转义标签值中的反斜杠、双引号和换行
+def escape_metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+METRICS = MetricsRegistry()
+
+# 汇总一次检查的指标并发布，配置了 metrics_textfile 时写入 node_exporter textfile 目录
+#   stage_timings: {阶段: 秒}，client_stats 为各下载器的获取结果，report_errors 为保存失败的报告和导出数
+def record_check_metrics(config, stage_timings, client_stats, nas_inventory, seeding_files, redundant_files,
+                         missing_files, check_stats, report_errors):
+    gauges = {}
+    counters = {}
+    
+    def gauge(name, value, **labels):
+        gauges[(name, tuple(sorted(labels.items())))] = value
+    
+    def counter(name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+    
+    for stage, elapsed in stage_timings.items():
+        gauge('stage_duration_seconds', elapsed, stage=stage)
+    
+    for client_id, stats in client_stats.items():
+        success = bool(stats.get('success'))
+        gauge('client_fetch_duration_seconds', stats.get('elapsed', 0.0), client=client_id)
+        gauge('client_fetch_success', int(success), client=client_id)
+        gauge('client_seeding_files', stats.get('file_count', 0), client=client_id)
+        counter('client_http_requests_total', stats.get('http_calls', 0), client=client_id)
+        counter('client_http_received_bytes_total', stats.get('http_bytes', 0), client=client_id)
+        counter('client_fetch_errors_total', int(not success), client=client_id)
+    
+    for directory, stats in nas_inventory.directory_stats.items():
+        gauge('scan_files', stats['files'], directory=directory)
+        gauge('scan_directories', stats['dirs'], directory=directory)
+        # 监视模式下本次检查没有扫描磁盘，只有实际扫描的目录才有耗时并计入 stat 次数
+        if 'elapsed' in stats:
+            gauge('scan_duration_seconds', stats['elapsed'], directory=directory)
+            counter('scan_stat_calls_total', stats.get('stat', 0), directory=directory)
+            counter('scan_errors_total', stats.get('error', 0), directory=directory)
+    
+    gauge('nas_files', len(nas_inventory.files))
+    gauge('seeding_files', len(seeding_files))
+    gauge('redundant_files', len(redundant_files))
+    gauge('redundant_bytes', sum(details.size_bytes for _, details in redundant_files))
+    gauge('missing_files', len(missing_files))
+    counter('missing_check_stat_calls_total', check_stats.get('stat_calls', 0))
+    counter('missing_check_scandir_calls_total', check_stats.get('scandir_calls', 0))
+    for report, error_count in report_errors.items():
+        counter('report_errors_total', error_count, report=report)
+    
+    success = all(stats.get('success') for stats in client_stats.values()) and not any(report_errors.values())
+    gauge('check_last_run_timestamp_seconds', int(time.time()))
+    gauge('check_last_run_success', int(success))
+    counter('check_runs_total', 1)
+    METRICS.publish(gauges, counters)
+    
+    metrics_textfile = config['general'].get('metrics_textfile', '').strip()
+    if metrics_textfile:
+        try:
+            write_report_atomic(metrics_textfile, METRICS.iter_lines())
+            logger.info(f"运行指标已写入: {metrics_textfile}")
+        except Exception as e:
+            logger.error(f"写入运行指标文件出错: {metrics_textfile}, 错误: {str(e)}")
+
+# 运行指标HTTP接口，只提供 GET /metrics
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        logger.debug(f"运行指标请求: {self.address_string()} {format % args}")
+
+# 守护进程模式下配置了 metrics_port 时在后台线程中启动运行指标HTTP接口
+# 接口没有认证，默认只监听本机地址，需要其他主机或容器外访问时通过 metrics_address 指定监听地址
+def start_metrics_server(config):
+    metrics_port = int(config['general'].get('metrics_port', 0))
+    if metrics_port <= 0:
+        return None
+    metrics_address = config['general'].get('metrics_address', '127.0.0.1').strip()
+    try:
+        server = ThreadingHTTPServer((metrics_address, metrics_port), MetricsRequestHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info(f"运行指标HTTP接口已启动: http://{metrics_address}:{metrics_port}/metrics")
+        return server
+    except Exception as e:
+        logger.error(f"启动运行指标HTTP接口失败: {str(e)}")
+        return None
+
+# 对比做种文件和NAS文件清单: reconcile 找出冗余文件，再确认不在清单中的做种文件，最后进行模糊匹配
+# 各阶段耗时记录到 stage_timings，丢失文件检查的统计记录到 check_stats，返回 (冗余文件, 丢失文件, 路径映射建议)
+def compare_seeding_files(config, seeding_files, nas_inventory, stage_timings, check_stats):
+    # 对比NAS文件和做种文件，找出冗余文件
+    stage_start_time = time.perf_counter()
+    reconcile_result = reconcile(nas_inventory.files, seeding_files, nas_inventory.inode_matching)
+    stage_timings['reconcile'] = time.perf_counter() - stage_start_time
+    redundant_files = reconcile_result['redundant']
+    timings = ', '.join(f"{stage} {elapsed:.3f} 秒" for stage, elapsed in reconcile_result['timings'].items())
+    logger.info(f"对比完成: {len(reconcile_result['matched'])} 个文件正在做种"
+                f"(其中 {reconcile_result['inode_matched']} 个为做种文件的硬链接), "
+                f"{len(reconcile_result['missing'])} 个做种文件不在NAS清单中, "
+                f"inode 查询 {reconcile_result['inode_stats']} 次, 耗时: {timings}")
+    
+    # 找出正在做种但已删除的文件：只需确认不在NAS清单中的做种文件
+    unchecked_files = []
+    stage_start_time = time.perf_counter()
+    missing_files = find_missing_seeding_files(reconcile_result['missing'], nas_inventory, check_stats, unchecked_files)
+    stage_timings['missing_check'] = time.perf_counter() - stage_start_time
+    
+    # 大小和文件名相同、只是路径不同的文件通常是路径映射错误，默认(suggest)只在报告中给出路径映射建议；
+    # 设为 true 时，同一映射匹配足够多的丢失文件才从两个列表中排除，设为 false 关闭
+    mapping_suggestions = {}
+    fuzzy_matching = config['general'].get('fuzzy_matching', 'suggest').strip().lower()
+    if fuzzy_matching not in ('false', 'no', '0', 'off'):
+        fuzzy_resolve = fuzzy_matching in ('true', 'yes', '1', 'on')
+        fuzzy_min_matches = max(1, int(config['general'].get('fuzzy_min_matches', 3)))
+        stage_start_time = time.perf_counter()
+        redundant_files, missing_files, mapping_suggestions = resolve_fuzzy_matches(
+            redundant_files, missing_files, unchecked_files, seeding_files, fuzzy_min_matches, fuzzy_resolve)
+        stage_timings['fuzzy_matching'] = time.perf_counter() - stage_start_time
+        for client_id, client_suggestions in mapping_suggestions.items():
+            for (source_prefix, nas_prefix), (count, applied) in client_suggestions.items():
+                if applied:
+                    logger.warning(f"下载器 {client_id} 的路径映射可能有误: {source_prefix} → {nas_prefix} 匹配 {count} 个文件")
+                else:
+                    logger.info(f"下载器 {client_id} 可能的路径映射: {source_prefix} → {nas_prefix} 匹配 {count} 个文件，未排除")
+    return redundant_files, missing_files, mapping_suggestions
 
 # 执行检查
-def run_check(config_file):
+# state 为守护进程主循环中跨多次检查保留的状态，包括增量同步快照(sync_states)和下载器连接(connections)
+def run_check(config_file, state=None):
     logger.info("开始检查冗余文件...")
     
     config = load_config(config_file)
@@ -1038,21 +3247,33 @@ def run_check(config_file):
         output_file_prefix = os.path.join('/app/output', output_file_prefix)
         logger.info(f"未指定输出路径，使用默认路径：{output_file_prefix}")
     
+    # 各阶段耗时，检查结束后与其他统计一起发布为运行指标
+    stage_timings = {}
+    check_start_time = time.perf_counter()
+    
     # 获取做种文件
-    seeding_files, seeding_torrents = get_seeding_files(config)
+    if state is None:
+        state = {}
+    client_stats = {}
+    stage_start_time = time.perf_counter()
+    seeding_files = get_seeding_files(
+        config, state.get('sync_states'), client_stats, state.get('connections'))
+    stage_timings['client_fetch'] = time.perf_counter() - stage_start_time
     logger.info(f"找到 {len(seeding_files)} 个做种文件")
     
-    # 获取NAS文件 - 使用新的多目录支持函数
-    nas_files = get_all_nas_files(config)
+    # 扫描NAS目录，构建冗余文件对比和丢失文件检查共用的文件清单
+    stage_start_time = time.perf_counter()
+    nas_inventory = build_nas_inventory(config, state.pop('full_rescan', False), state.get('nas_watcher'))
+    stage_timings['scan'] = time.perf_counter() - stage_start_time
+    nas_files = nas_inventory.files
     size_threshold = int(config['general'].get('size_threshold', 100))
     logger.info(f"找到 {len(nas_files)} 个NAS文件 (大于 {size_threshold}MB)")
     
-    # 找出冗余文件
-    redundant_files = find_redundant_files(nas_files, seeding_files)
+    # 对比NAS文件和做种文件，找出冗余文件和正在做种但已删除的文件
+    check_stats = {}
+    redundant_files, missing_files, mapping_suggestions = compare_seeding_files(
+        config, seeding_files, nas_inventory, stage_timings, check_stats)
     logger.info(f"找到 {len(redundant_files)} 个冗余文件")
-    
-    # 找出正在做种但已删除的文件
-    missing_files = find_missing_seeding_files(seeding_files, seeding_torrents)
     logger.info(f"找到 {len(missing_files)} 个正在做种但已删除的文件")
     
     # 设置时间戳和输出路径
@@ -1109,52 +3330,95 @@ def run_check(config_file):
             os.makedirs("/app/output", exist_ok=True)
         logger.info(f"将使用备选路径: {redundant_output_path} 和 {missing_output_path}")
     
-    # 格式化输出内容
-    output_content = format_output(redundant_files, len(nas_files), len(seeding_files))
-    missing_output_content = format_missing_seeding_output(missing_files)
-    
-    try:
-        # 保存冗余文件报告
-        with open(redundant_output_path, 'w', encoding='utf-8') as f:
-            f.write(output_content)
-        logger.info(f"冗余文件列表已保存到: {redundant_output_path}")
-        
-        # 保存缺失文件报告
-        with open(missing_output_path, 'w', encoding='utf-8') as f:
-            f.write(missing_output_content)
-        logger.info(f"已删除做种文件列表已保存到: {missing_output_path}")
-        
-    except Exception as e:
-        logger.error(f"保存结果文件时出错: {str(e)}")
-        # 尝试使用另一个位置
+    # 流式写入报告，compress_reports 开启时使用gzip压缩
+    # report_mode: full 只生成完整报告，delta 只生成与上次检查相比的变化报告，both 两者都生成
+    compress_reports = config['general'].get('compress_reports', 'false').lower() in ('true', 'yes', '1', 'on')
+    suffix = '.gz' if compress_reports else ''
+    report_mode = config['general'].get('report_mode', 'full').lower()
+    if report_mode not in ('full', 'delta', 'both'):
+        logger.warning(f"无效的 report_mode 配置: {report_mode}，使用 full")
+        report_mode = 'full'
+    
+    # 记录本次检查结果
+    results_store = open_results_store(config)
+    run_id = None
+    if results_store is not None:
         try:
-            # 确保备选目录存在
-            os.makedirs("/app/output", exist_ok=True)
-            alt_path = f"/app/output/redundant_files_{timestamp}.txt"
-            alt_missing_path = f"/app/output/missing_files_{timestamp}.txt"
-            
-            logger.info(f"尝试保存到备选位置: {alt_path} 和 {alt_missing_path}")
-            
-            with open(alt_path, 'w', encoding='utf-8') as f:
-                f.write(output_content)
-            
-            with open(alt_missing_path, 'w', encoding='utf-8') as f:
-                f.write(missing_output_content)
-            
-            logger.info(f"报告已保存到备选位置: {alt_path} 和 {alt_missing_path}")
-        except Exception as e2:
-            logger.error(f"保存到备选位置也失败: {str(e2)}")
-            logger.info("直接打印结果:")
-            logger.info(output_content)
-            logger.info(missing_output_content)
+            failed_clients = [client_id for client_id, stats in client_stats.items() if not stats.get('success')]
+            run_id = results_store.record_run(len(nas_files), len(seeding_files), redundant_files, missing_files,
+                                              failed_clients)
+            logger.info(f"检查结果已记录到数据库: {results_store.db_path} (检查 #{run_id})")
+        except Exception as e:
+            logger.error(f"记录检查结果出错: {str(e)}")
+    
+    # 保存到备选位置或未能保存的报告计为一次报告错误
+    report_errors = {}
+    stage_start_time = time.perf_counter()
+    if report_mode in ('full', 'both') or run_id is None:
+        saved_path = save_report(
+            "冗余文件列表", redundant_output_path + suffix, f"/app/output/redundant_files_{timestamp}.txt{suffix}",
+            lambda summary: iter_redundant_report_lines(redundant_files, len(nas_files), len(seeding_files),
+                                                        client_stats, mapping_suggestions, summary))
+        report_errors['redundant'] = int(saved_path != redundant_output_path + suffix)
+        saved_path = save_report(
+            "已删除做种文件列表", missing_output_path + suffix, f"/app/output/missing_files_{timestamp}.txt{suffix}",
+            lambda summary: iter_missing_report_lines(missing_files, client_stats, mapping_suggestions, summary))
+        report_errors['missing'] = int(saved_path != missing_output_path + suffix)
+    
+    if report_mode in ('delta', 'both') and run_id is not None:
+        if "redundant_files" in redundant_output_path:
+            delta_output_path = redundant_output_path.replace("redundant_files", "delta_files")
+        else:
+            delta_output_path = f"{os.path.splitext(redundant_output_path)[0]}_delta.txt"
+        previous_run_id = results_store.get_previous_run_id(run_id)
+        saved_path = save_report(
+            "变化报告", delta_output_path + suffix, f"/app/output/delta_files_{timestamp}.txt{suffix}",
+            lambda summary: iter_delta_report_lines(results_store, run_id, previous_run_id, client_stats, summary))
+        report_errors['delta'] = int(saved_path != delta_output_path + suffix)
+    
+    if results_store is not None:
+        results_store.close()
+    stage_timings['report'] = time.perf_counter() - stage_start_time
+    
+    # 机器可读的导出文件：export_formats 为逗号分隔的 jsonl、csv，export_inventories 开启时同时导出完整清单
+    export_formats = [fmt.strip().lower() for fmt in config['general'].get('export_formats', '').split(',') if fmt.strip()]
+    if export_formats:
+        exports = [
+            (os.path.splitext(redundant_output_path)[0], NAS_EXPORT_FIELDS, lambda: iter_nas_export_rows(redundant_files)),
+            (os.path.splitext(missing_output_path)[0], SEEDING_EXPORT_FIELDS, lambda: iter_seeding_export_rows(missing_files)),
+        ]
+        if config['general'].get('export_inventories', 'false').lower() in ('true', 'yes', '1', 'on'):
+            export_dir = os.path.dirname(redundant_output_path)
+            exports.append((os.path.join(export_dir, f"nas_inventory_{timestamp}"), NAS_EXPORT_FIELDS,
+                            lambda: iter_nas_export_rows(nas_files)))
+            exports.append((os.path.join(export_dir, f"seeding_inventory_{timestamp}"), SEEDING_EXPORT_FIELDS,
+                            lambda: iter_seeding_export_rows(seeding_files)))
+        stage_start_time = time.perf_counter()
+        report_errors['export'] = save_exports(exports, export_formats, suffix)
+        stage_timings['export'] = time.perf_counter() - stage_start_time
+    
+    stage_timings['total'] = time.perf_counter() - check_start_time
+    record_check_metrics(config, stage_timings, client_stats, nas_inventory, seeding_files, redundant_files,
+                         missing_files, check_stats, report_errors)
 
 # 主函数
 def main():
     parser = argparse.ArgumentParser(description='检查NAS中未做种的冗余文件')
     parser.add_argument('--now', action='store_true', help='立即执行检查')
     parser.add_argument('--config', default='config.ini', help='配置文件路径')
+    parser.add_argument('--full-rescan', action='store_true', help='启动后的第一次检查忽略增量扫描索引，完整扫描NAS目录')
+    parser.add_argument('--query', choices=('redundant', 'missing', 'runs'),
+                        help='查询检查结果数据库后退出：最近一次检查的冗余文件、丢失文件，或检查记录列表')
+    parser.add_argument('--client', help='与 --query missing 一起使用，只列出指定下载器的文件')
+    parser.add_argument('--run', type=int, help='与 --query 一起使用，查询指定编号的检查，默认最近一次')
     args = parser.parse_args()
     
+    if args.query:
+        # 查询结果输出到标准输出，只保留警告和错误日志，便于在管道中使用
+        logger.setLevel(logging.WARNING)
+        query_results(load_config(args.config), args.query, args.client, args.run)
+        return
+    
     try:
         # 加载配置
         logger.info(f"使用配置文件: {args.config}")
@@ -1182,19 +3446,48 @@ def main():
         schedule_time = config['general'].get('schedule_time', '03:00')
         logger.info(f"计划任务时间: {schedule_time}")
         
+        # 在主循环中跨多次检查保留的状态：qBittorrent增量同步快照和下载器长连接
+        # full_rescan 只作用于启动后的第一次检查，使用后即从状态中移除
+        state = {'sync_states': {}, 'connections': {}, 'full_rescan': args.full_rescan}
+        
+        # 监视模式：启动时扫描一次NAS目录，之后由 inotify 事件维护文件清单，每次检查不再遍历磁盘
+        watch_mode = config['general'].get('watch_mode', 'false').lower() in ('true', 'yes', '1', 'on')
+        if watch_mode:
+            settings = get_nas_scan_settings(config)
+            if settings is not None:
+                try:
+                    refresh_interval = float(config['general'].get('watch_refresh_interval', 60))
+                    nas_watcher = NasWatcher(settings, refresh_interval)
+                    nas_watcher.start()
+                    state['nas_watcher'] = nas_watcher
+                    logger.info("已启用NAS目录监视模式")
+                except Exception as e:
+                    logger.error(f"启用NAS目录监视模式失败，将使用常规扫描: {str(e)}")
+        
+        # 配置了 metrics_port 时通过HTTP提供运行指标
+        start_metrics_server(config)
+        
+        # 收到 SIGUSR1 信号时立即执行一次检查，监视模式下检查只需对比内存中的文件清单
+        check_requested = threading.Event()
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: check_requested.set())
+        
         # 设置定时任务
-        schedule.every().day.at(schedule_time).do(run_check,args.config)
+        schedule.every().day.at(schedule_time).do(run_check, args.config, state)
         logger.info(f"已设置每日 {schedule_time} 执行检查")
         
         # 无论--now参数是否指定，都立即执行一次检查
         logger.info("程序启动，立即执行检查...")
-        run_check(args.config)
+        run_check(args.config, state)
         
         # 保持程序运行
         logger.info("进入主循环，等待执行计划任务...")
         while True:
             schedule.run_pending()
-            time.sleep(60)
+            if check_requested.wait(60):
+                check_requested.clear()
+                logger.info("收到 SIGUSR1 信号，立即执行检查...")
+                run_check(args.config, state)
     
     except Exception as e:
         logger.error(f"程序运行出错: {str(e)}")
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 性能基准测试
+# reconcile: 使用合成的路径数据测量 reconcile 对比NAS文件和做种文件的耗时
+#   用法: python benchmark.py --sizes 10000,100000,1000000,3000000
+#   每个规模下NAS文件和做种文件各一半重叠，输出总耗时、各阶段耗时以及每条路径的平均耗时，
+#   平均耗时基本不随规模增长说明对比是线性的；--legacy 会额外运行旧的逐个列表查找实现作对比(仅适合小规模)
+# pipeline: 在磁盘上生成合成的NAS目录树，启动本地模拟的qBittorrent和Transmission服务器，
+#   按 run_check 的流程分别测量获取做种文件、路径映射、扫描、对比、丢失检查和写报告各阶段的耗时
+#   用法: python benchmark.py --suite pipeline --pipeline-sizes 10000,100000,1000000 --latency 0.005 --json bench.json
+# fuzzy: 用内存中的数据检查模糊匹配的结果，不一致时抛出 AssertionError
+#   用法: python benchmark.py --suite fuzzy
+
+import argparse
+import configparser
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import app
+
+# 旧实现：对每个NAS文件在做种文件列表中线性查找，复杂度为 NAS文件数 × 做种文件数
+def legacy_find_redundant_files(nas_files, seeding_files):
+    seeding_files_normalized = [app.os.path.normpath(f) for f in seeding_files]
+    return [(file_path, details) for file_path, details in nas_files
+            if app.os.path.normpath(file_path) not in seeding_files_normalized]
+
+# 生成合成数据：count 个NAS文件和 count 个做种文件，其中一半路径相同
+def generate_paths(count):
+    details = app.NasFileRecord(0, 0, 0, 'mkv', '视频')
+    client = app.ClientInfo('qBittorrent', 'qb', '127.0.0.1:8080')
+    torrent = app.TorrentInfo(client, 'Benchmark', '0' * 40, 'uploading', '/vol2/downloads')
+    nas_files = []
+    seeding_files = []
+    for i in range(count):
+        directory = f"/vol1/1000/media/{i % 1000:03d}/Show.{i // 1000}.S01.1080p"
+        nas_files.append((f"{directory}/Episode.{i}.mkv", details))
+        if i % 2 == 0:
+            file_path = f"{directory}/Episode.{i}.mkv"
+        else:
+            file_path = f"/vol2/downloads/{i % 1000:03d}/Torrent.{i}.mkv"
+        seeding_files.append(app.SeedingFile(file_path, file_path, 0, torrent))
+    return nas_files, seeding_files
+
+def run_benchmark(sizes, legacy=False):
+    results = []
+    for count in sizes:
+        nas_files, seeding_files = generate_paths(count)
+
+        start_time = time.perf_counter()
+        result = app.reconcile(nas_files, seeding_files)
+        elapsed = time.perf_counter() - start_time
+
+        entry = {
+            'paths': count,
+            'elapsed': round(elapsed, 4),
+            'ns_per_path': round(elapsed * 1e9 / (2 * count), 1),
+            'redundant': len(result['redundant']),
+            'matched': len(result['matched']),
+            'missing': len(result['missing']),
+            'timings': {stage: round(value, 4) for stage, value in result['timings'].items()},
+        }
+
+        if legacy:
+            start_time = time.perf_counter()
+            legacy_redundant = legacy_find_redundant_files(nas_files, [f.file_path for f in seeding_files])
+            entry['legacy_elapsed'] = round(time.perf_counter() - start_time, 4)
+            if legacy_redundant != result['redundant']:
+                raise AssertionError("reconcile 与旧实现的冗余文件结果不一致")
+
+        print(f"{count:>10} 条路径: 耗时 {entry['elapsed']:.3f} 秒, 每条路径 {entry['ns_per_path']} ns"
+              + (f", 旧实现 {entry['legacy_elapsed']:.3f} 秒" if legacy else ""))
+        results.append(entry)
+    return results
+
+# 检查模糊匹配只在确认路径映射错误时排除结果
+def check_fuzzy_matching():
+    client = app.ClientInfo('qBittorrent', 'qb', '127.0.0.1:8080')
+    def seeding_file(file_path, original_path, file_size):
+        torrent = app.TorrentInfo(client, f"Torrent.{file_size}", f"{file_size:040d}", 'uploading', '/downloads')
+        return app.SeedingFile(file_path, original_path, file_size, torrent)
+    def redundant(nas_root):
+        return [(f"{nas_root}/Show.{i}/Episode.{i}.mkv", app.NasFileRecord(i + 1, 0, 0, 'mkv', '视频')) for i in range(5)]
+
+    # 映射错误: 映射后的路径不存在，NAS中有同名同大小的文件
+    missing = [seeding_file(f"/wrong/Show.{i}/Episode.{i}.mkv", f"/downloads/Show.{i}/Episode.{i}.mkv", i + 1)
+               for i in range(5)]
+    for resolve, expected in ((False, 5), (True, 0)):
+        remaining_redundant, remaining_missing, suggestions = app.resolve_fuzzy_matches(
+            redundant('/nas'), missing, (), missing, 3, resolve)
+        if len(remaining_redundant) != expected or len(remaining_missing) != expected:
+            raise AssertionError(f"路径映射错误的排除结果不正确(resolve={resolve})")
+        if suggestions != {'qb': {('/downloads', '/nas'): (5, resolve)}}:
+            raise AssertionError(f"路径映射建议不正确(resolve={resolve})")
+
+    # 下载器在NAS目录之外的卷上做种，NAS中的同名同大小副本不是硬链接，仍是冗余文件
+    unchecked = [seeding_file(f"/vol3/seed/Show.{i}/Episode.{i}.mkv", f"/vol3/seed/Show.{i}/Episode.{i}.mkv", i + 1)
+                 for i in range(5)]
+    for resolve in (False, True):
+        remaining_redundant, _, suggestions = app.resolve_fuzzy_matches(
+            redundant('/nas/library'), [], unchecked, unchecked, 3, resolve)
+        if len(remaining_redundant) != 5:
+            raise AssertionError(f"NAS目录之外的做种文件排除了冗余文件(resolve={resolve})")
+        if suggestions != {'qb': {('/vol3/seed', '/nas/library'): (5, False)}}:
+            raise AssertionError(f"NAS目录之外的做种文件的路径映射建议不正确(resolve={resolve})")
+
+    # 单个移动过的文件不足以确认映射错误
+    moved = [seeding_file('/nas/downloads/Movie/Movie.mkv', '/downloads/Movie/Movie.mkv', 1)]
+    remaining_redundant, remaining_missing, _ = app.resolve_fuzzy_matches(
+        [('/nas/library/Movie.mkv', app.NasFileRecord(1, 0, 0, 'mkv', '视频'))], moved, (), moved, 3, True)
+    if len(remaining_redundant) != 1 or len(remaining_missing) != 1:
+        raise AssertionError("单个移动过的文件被按路径映射错误排除")
+    print("模糊匹配检查通过")
+
+# 目录树的生成方式变化时递增，workdir 中旧版本的目录树会被重新生成
+TREE_VERSION = 1
+
+# 生成合成的NAS目录树，返回种子列表 [{'name', 'directory', 'files': [(文件名, 大小)]}]
+# 每个种子一个目录，位于 depth 层、每层 fanout 个子目录之下，每个种子 files_per_torrent 个稀疏文件
+#   每 10 个种子中有 1 个不在下载器中(冗余文件)，deleted_ratio 比例的做种文件不在磁盘上(丢失文件)
+#   hardlink_ratio 比例的文件在 library 目录中有一个硬链接副本，symlink_ratio 比例的文件在 links 目录中有一个软链接
+#   exclude_ratio 比例的种子目录中有一个应被排除的 @eaDir 子目录
+def generate_nas_tree(nas_root, file_count, depth=3, fanout=10, files_per_torrent=10, hardlink_ratio=0.05,
+                      symlink_ratio=0.01, exclude_ratio=0.02, deleted_ratio=0.01):
+    torrent_count = max(1, file_count // files_per_torrent)
+    library_dir = os.path.join(nas_root, 'library')
+    links_dir = os.path.join(nas_root, 'links')
+    os.makedirs(library_dir, exist_ok=True)
+    os.makedirs(links_dir, exist_ok=True)
+
+    # 按比例取整数间隔，比例为 0 时不生成
+    def every(ratio):
+        return int(round(1 / ratio)) if ratio > 0 else 0
+    hardlink_every, symlink_every = every(hardlink_ratio), every(symlink_ratio)
+    exclude_every, deleted_every = every(exclude_ratio), every(deleted_ratio)
+
+    torrents = []
+    file_index = 0
+    for t in range(torrent_count):
+        parts = []
+        value = t
+        for _ in range(depth):
+            parts.append(f"d{value % fanout:02d}")
+            value //= fanout
+        relative_dir = os.path.join(*parts, f"Torrent.{t:07d}") if parts else f"Torrent.{t:07d}"
+        directory = os.path.join(nas_root, relative_dir)
+        os.makedirs(directory, exist_ok=True)
+
+        files = []
+        for j in range(files_per_torrent):
+            file_name = f"Episode.{j:02d}.mkv"
+            file_size = 4096 + file_index
+            files.append((file_name, file_size))
+            file_path = os.path.join(directory, file_name)
+            file_index += 1
+            if deleted_every and file_index % deleted_every == deleted_every // 2:
+                continue
+            with open(file_path, 'wb') as f:
+                f.truncate(file_size)
+            if hardlink_every and file_index % hardlink_every == 0:
+                os.link(file_path, os.path.join(library_dir, f"{t:07d}.{file_name}"))
+            if symlink_every and file_index % symlink_every == 0:
+                os.symlink(file_path, os.path.join(links_dir, f"{t:07d}.{file_name}"))
+
+        if exclude_every and t % exclude_every == 0:
+            metadata_dir = os.path.join(directory, '@eaDir')
+            os.makedirs(metadata_dir, exist_ok=True)
+            with open(os.path.join(metadata_dir, 'SYNOINDEX_MEDIA_INFO'), 'wb') as f:
+                f.truncate(4096)
+
+        torrents.append({'name': f"Torrent.{t:07d}", 'directory': relative_dir, 'files': files,
+                         'seeding': t % 10 != 9})
+    return torrents
+
+# 模拟的下载器服务器：在本地端口上实现 qBittorrent 的 auth/login、torrents/info、torrents/files，
+# 以及 Transmission RPC 的 torrent-get(含 409 会话ID握手和 table 格式)，每个请求先等待 latency 秒
+# 服务器运行在单独的进程中，避免与被测的客户端争用GIL而使测得的获取耗时偏高
+class FakeDownloaderServer:
+    def __init__(self, client_type, torrents, download_dir, latency=0.0):
+        self.client_type = client_type
+        self.latency = latency
+        self.request_count = multiprocessing.Value('l', 0)
+        self.torrents = []
+        for i, torrent in enumerate(torrents):
+            self.torrents.append({
+                'id': i + 1,
+                'hash': f"{i + (0 if client_type == 'qbittorrent' else 1 << 60):040x}",
+                'name': torrent['name'],
+                'save_path': os.path.join(download_dir, os.path.dirname(torrent['directory'])),
+                'files': [(os.path.join(os.path.basename(torrent['directory']), name), size)
+                          for name, size in torrent['files']],
+            })
+        self.by_hash = {torrent['hash']: torrent for torrent in self.torrents}
+        self.by_id = {torrent['id']: torrent for torrent in self.torrents}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.process = multiprocessing.get_context('fork').Process(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.process.start()
+        # 监听套接字已由子进程继承，父进程中的副本不再需要
+        self.server.server_close()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    @property
+    def requests(self):
+        return self.request_count.value
+
+    def count_request(self):
+        with self.request_count.get_lock():
+            self.request_count.value += 1
+
+    # Transmission torrent-get 的单个种子字段
+    def transmission_fields(self, torrent, fields):
+        values = {
+            'id': torrent['id'],
+            'hashString': torrent['hash'],
+            'name': torrent['name'],
+            'downloadDir': torrent['save_path'],
+            'status': 6,
+            'percentDone': 1,
+            'totalSize': sum(size for _, size in torrent['files']),
+            'files': [{'name': name, 'length': size, 'bytesCompleted': size} for name, size in torrent['files']],
+        }
+        return [values.get(field) for field in fields]
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # 响应头和响应体分两次发送，不关闭 Nagle 算法时会与客户端的延迟确认叠加，每个请求多出约 40ms
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, body, status=200, headers=None):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                fake.count_request()
+                time.sleep(fake.latency)
+                url = urlparse(self.path)
+                if url.path == '/api/v2/torrents/info':
+                    return self.send([{'hash': t['hash'], 'name': t['name'], 'save_path': t['save_path'],
+                                       'state': 'uploading'} for t in fake.torrents])
+                if url.path == '/api/v2/torrents/files':
+                    torrent = fake.by_hash.get(parse_qs(url.query).get('hash', [''])[0])
+                    if torrent is None:
+                        return self.send(b'Not Found', 404)
+                    return self.send([{'name': name, 'size': size} for name, size in torrent['files']])
+                self.send(b'Not Found', 404)
+
+            def do_POST(self):
+                fake.count_request()
+                time.sleep(fake.latency)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path == '/api/v2/auth/login':
+                    return self.send(b'Ok.', 200, {'Set-Cookie': 'SID=benchmark; path=/'})
+                if self.path == '/transmission/rpc':
+                    if self.headers.get('X-Transmission-Session-Id') != 'benchmark':
+                        return self.send(b'', 409, {'X-Transmission-Session-Id': 'benchmark'})
+                    arguments = json.loads(body).get('arguments', {})
+                    fields = arguments.get('fields', [])
+                    ids = arguments.get('ids')
+                    torrents = fake.torrents if ids is None else [fake.by_id[i] for i in ids if i in fake.by_id]
+                    rows = [fake.transmission_fields(torrent, fields) for torrent in torrents]
+                    if arguments.get('format') == 'table':
+                        result = [fields] + rows
+                    else:
+                        result = [dict(zip(fields, row)) for row in rows]
+                    return self.send({'arguments': {'torrents': result}, 'result': 'success'})
+                self.send(b'Not Found', 404)
+
+        return Handler
+
+# 测量一个阶段的耗时，返回函数结果
+def timed(timings, stage, func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[stage] = round(time.perf_counter() - start_time, 4)
+    return result
+
+# 按 run_check 的流程逐阶段测量，每个规模的目录树保存在 workdir 下，参数相同时复用已生成的目录树
+def run_pipeline_benchmark(sizes, workdir, latency=0.0, tree_options=None):
+    tree_options = tree_options or {}
+    results = []
+    for count in sizes:
+        size_dir = os.path.join(workdir, f"files_{count}")
+        nas_root = os.path.join(size_dir, 'nas')
+        manifest_path = os.path.join(size_dir, 'manifest.json')
+        manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != TREE_VERSION or manifest.get('options') != tree_options:
+                manifest = None
+
+        start_time = time.perf_counter()
+        if manifest is None:
+            shutil.rmtree(size_dir, ignore_errors=True)
+            torrents = generate_nas_tree(nas_root, count, **tree_options)
+            manifest = {'version': TREE_VERSION, 'options': tree_options, 'torrents': torrents}
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+            print(f"{count:>10} 个文件: 生成目录树耗时 {time.perf_counter() - start_time:.1f} 秒")
+        seeding_torrents = [torrent for torrent in manifest['torrents'] if torrent['seeding']]
+
+        # 做种的种子交替分配给两个下载器
+        servers = [
+            FakeDownloaderServer('qbittorrent', seeding_torrents[0::2], '/downloads', latency).start(),
+            FakeDownloaderServer('transmission', seeding_torrents[1::2], '/downloads', latency).start(),
+        ]
+        output_dir = os.path.join(size_dir, 'output')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'general': {'nas_directories': nas_root, 'size_threshold': '0', 'exclude_directories': '*/@eaDir',
+                        'output_file': os.path.join(output_dir, 'redundant_files'), 'incremental_scan': 'false',
+                        'results_db': 'false'},
+            'downloader': {'enabled_clients': 'qb, tr'},
+            'qb': {'type': 'qbittorrent', 'host': '127.0.0.1', 'port': str(servers[0].port),
+                   'path_mappings': f"/downloads={nas_root}", 'max_concurrency': '8'},
+            'tr': {'type': 'transmission', 'host': '127.0.0.1', 'port': str(servers[1].port),
+                   'path_mappings': f"/downloads={nas_root}"},
+        })
+
+        timings = {}
+        try:
+            client_stats = {}
+            seeding_files = timed(timings, 'client_fetch', app.get_seeding_files, config, {}, client_stats)
+            mapper = app.compile_path_mappings(f"/downloads={nas_root}")
+            timed(timings, 'mapping', lambda: [mapper.map(f.original_path) for f in seeding_files])
+            nas_inventory = timed(timings, 'scan', app.build_nas_inventory, config)
+            # 对比、丢失文件检查和模糊匹配与 run_check 共用同一流程，各阶段耗时由其记录
+            stage_timings = {}
+            redundant_files, missing_files, mapping_suggestions = app.compare_seeding_files(
+                config, seeding_files, nas_inventory, stage_timings, {})
+            timings.update((stage, round(elapsed, 4)) for stage, elapsed in stage_timings.items())
+
+            def write_reports():
+                app.save_report("冗余文件列表", os.path.join(output_dir, 'redundant_files.txt'), os.path.join(output_dir, 'redundant_files.txt'),
+                                lambda summary: app.iter_redundant_report_lines(
+                                    redundant_files, len(nas_inventory.files), len(seeding_files), client_stats,
+                                    mapping_suggestions, summary))
+                app.save_report("已删除做种文件列表", os.path.join(output_dir, 'missing_files.txt'), os.path.join(output_dir, 'missing_files.txt'),
+                                lambda summary: app.iter_missing_report_lines(
+                                    missing_files, client_stats, mapping_suggestions, summary))
+            os.makedirs(output_dir, exist_ok=True)
+            timed(timings, 'report', write_reports)
+        finally:
+            for server in servers:
+                server.stop()
+
+        entry = {
+            'files': count,
+            'torrents': len(manifest['torrents']),
+            'latency': latency,
+            'timings': timings,
+            'total': round(sum(timings.values()), 4),
+            'counts': {
+                'seeding_files': len(seeding_files),
+                'nas_files': len(nas_inventory.files),
+                'redundant': len(redundant_files),
+                'missing': len(missing_files),
+                'http_requests': sum(server.requests for server in servers),
+            },
+        }
+        stages = ', '.join(f"{stage} {elapsed:.3f}" for stage, elapsed in timings.items())
+        print(f"{count:>10} 个文件: 总耗时 {entry['total']:.3f} 秒 ({stages})")
+        results.append(entry)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='seeding-checker 性能基准测试')
+    parser.add_argument('--suite', choices=('reconcile', 'pipeline', 'fuzzy', 'all'), default='reconcile', help='运行的基准测试')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='reconcile: 逗号分隔的路径数量')
+    parser.add_argument('--legacy', action='store_true', help='reconcile: 同时运行旧的列表查找实现作对比')
+    parser.add_argument('--pipeline-sizes', default='10000,100000,1000000', help='pipeline: 逗号分隔的NAS文件数量')
+    parser.add_argument('--workdir', help='pipeline: 生成目录树的位置，默认使用临时目录并在结束后删除')
+    parser.add_argument('--latency', type=float, default=0.0, help='pipeline: 模拟下载器每个请求的延迟(秒)')
+    parser.add_argument('--depth', type=int, default=3, help='pipeline: 种子目录之上的目录层数')
+    parser.add_argument('--fanout', type=int, default=10, help='pipeline: 每层的子目录数')
+    parser.add_argument('--files-per-torrent', type=int, default=10, help='pipeline: 每个种子的文件数')
+    parser.add_argument('--hardlink-ratio', type=float, default=0.05, help='pipeline: 有硬链接副本的文件比例')
+    parser.add_argument('--symlink-ratio', type=float, default=0.01, help='pipeline: 有软链接的文件比例')
+    parser.add_argument('--exclude-ratio', type=float, default=0.02, help='pipeline: 含 @eaDir 排除目录的种子比例')
+    parser.add_argument('--deleted-ratio', type=float, default=0.01, help='pipeline: 做种但已从磁盘删除的文件比例')
+    parser.add_argument('--json', help='将结果保存为JSON文件')
+    args = parser.parse_args()
+
+    # 基准测试只关心耗时，关闭 app 的日志输出
+    logging.disable(logging.INFO)
+
+    output = {}
+    if args.suite in ('reconcile', 'all'):
+        sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+        output['reconcile'] = run_benchmark(sizes, args.legacy)
+
+    if args.suite in ('fuzzy', 'all'):
+        check_fuzzy_matching()
+
+    if args.suite in ('pipeline', 'all'):
+        sizes = [int(size) for size in args.pipeline_sizes.split(',') if size.strip()]
+        tree_options = {
+            'depth': args.depth, 'fanout': args.fanout, 'files_per_torrent': args.files_per_torrent,
+            'hardlink_ratio': args.hardlink_ratio, 'symlink_ratio': args.symlink_ratio,
+            'exclude_ratio': args.exclude_ratio, 'deleted_ratio': args.deleted_ratio,
+        }
+        workdir = args.workdir or tempfile.mkdtemp(prefix='seeding-checker-bench-')
+        try:
+            output['pipeline'] = run_pipeline_benchmark(sizes, workdir, args.latency, tree_options)
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到: {args.json}")
+
+if __name__ == "__main__":
+    main()